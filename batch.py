@@ -1,56 +1,153 @@
 import os
+import sys
+import json
+import select
 import threading
 import subprocess
 import argparse
+import Queue
 
 from tqdm import tqdm
 
-maxConcurrentThreads = 5
 # Disable subprocess call output
 FNULL = open(os.devnull, 'w')
-cmdf = "python %s --input %s --output %s --model %s --offset_x %d --offset_y %d"
 
 verbose = False
 
-def sq(s):
-    # Escpae Bash Scripts
-    return "'" + s.replace("'", "'\\''") + "'"
-
-class runMyBash (threading.Thread):
-   def __init__(self, cmd):
-      threading.Thread.__init__(self)
-      self.cmd = cmd
-
-   def run(self):
-       if not verbose:
-           subprocess.call(self.cmd, shell=True, stdout=FNULL, stderr=subprocess.STDOUT)
-       else:
-           subprocess.call(self.cmd, shell=True)
-
-
-def batch_demosaic_with_djdd(dir, output, dem_bin = "./bin/demosaic", model = "./pretrained_models/bayer/"
-    , offx = "1", offy = "0", gpu = True):
 
+class DemosaickWorker(object):
+    """A long-lived `demosaick --serve` process with its network loaded once."""
+
+    def __init__(self, dem_bin, model, output, offx, offy, gpu, backend = "caffe"):
+        self.cmd = [sys.executable, dem_bin, "--serve", "--queue_size", "1",
+                    "--model", model, "--output", output,
+                    "--offset_x", str(offx), "--offset_y", str(offy),
+                    "--backend", backend]
+        if gpu:
+            self.cmd.append("--gpu")
+        self.proc = None
+
+    def start(self):
+        if verbose:
+            stderr = None
+        else:
+            stderr = FNULL
+        self.proc = subprocess.Popen(self.cmd, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, stderr=stderr)
+
+    def stop(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        self.proc = None
+
+    def run(self, f, timeout):
+        """Demosaicks file f, returns the worker's response.
+
+        The worker is killed and restarted on the next job if it does not
+        answer within timeout seconds or dies while processing.
+        """
+        if self.proc is None or self.proc.poll() is not None:
+            self.start()
+
+        try:
+            self.proc.stdin.write(json.dumps({"input": f}) + "\n")
+            self.proc.stdin.flush()
+            ready, _, _ = select.select([self.proc.stdout], [], [], timeout)
+            line = ready and self.proc.stdout.readline()
+        except IOError as e:
+            self.stop()
+            return {"status": "error", "error": "worker died: %s" % e}
+
+        if not ready:
+            self.stop()
+            return {"status": "timeout", "error": "no answer after %ds" % timeout}
+        if not line:
+            self.stop()
+            return {"status": "error", "error": "worker exited"}
+        return json.loads(line)
+
+
+def load_manifest(manifest):
+    """Returns the set of inputs the manifest records as successfully processed."""
+    done = set()
+    if os.path.exists(manifest):
+        with open(manifest) as fid:
+            for line in fid:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # Truncated by an interrupted run
+                if record["status"] == "ok" and os.path.exists(record["output"]):
+                    done.add(record["input"])
+    return done
+
+
+def batch_demosaic_with_djdd(dir, output, dem_bin = "./bin/demosaick", model = "./pretrained_models/bayer/"
+    , offx = 1, offy = 0, gpu = True, workers = 4, timeout = 600, retries = 1, manifest = None, backend = "caffe"):
+    """Demosaicks every file under dir with a pool of persistent workers.
+
+    Jobs already recorded as done in the manifest are skipped, so an
+    interrupted batch can be resumed by running it again.
+
+    Return: (number of processed, skipped and failed files)
+    """
+
+    if manifest is None:
+        manifest = os.path.join(output, "batch_manifest.jsonl")
+    done = load_manifest(manifest)
+
+    pending = Queue.Queue()
+    skipped = 0
     for (root, dirnames, filenames) in os.walk(dir):
-        if not verbose:
-            pbar = tqdm(total = len(filenames))
-        for name in filenames:
-            while (threading.activeCount() > maxConcurrentThreads):
-                pass #Avoid too many workers.
-            f = root + name
-            if not gpu:
-                cmd = cmdf % (sq(dem_bin), sq(f), sq(output), sq(model), offx, offy)
+        for name in sorted(filenames):
+            f = os.path.join(root, name)
+            if f in done:
+                skipped += 1
             else:
-                cmd = cmdf % (sq(dem_bin), sq(f), sq(output), sq(model), offx, offy) + " --gpu"
-            # print cmd
-            bashThr = runMyBash(cmd=cmd)
-            bashThr.start()
-            if not verbose: pbar.update(1)
-
-    while (threading.activeCount() > 1):
-        pass #Block till all workers finishes.
-
-    if not verbose: pbar.close
+                pending.put(f)
+
+    counts = {"ok": 0, "failed": 0}
+    lock = threading.Lock()
+    pbar = tqdm(total = pending.qsize(), disable = verbose)
+
+    def _work():
+        worker = DemosaickWorker(dem_bin, model, output, offx, offy, gpu, backend)
+        while True:
+            try:
+                f = pending.get_nowait()
+            except Queue.Empty:
+                break
+
+            for attempt in range(retries + 1):
+                response = worker.run(f, timeout)
+                if response["status"] == "ok":
+                    break
+                if verbose:
+                    print "%s failed (attempt %d): %s" % (f, attempt + 1, response.get("error"))
+
+            record = {"input": f, "output": os.path.join(output, os.path.basename(f)),
+                      "status": response["status"], "attempts": attempt + 1,
+                      "latency_ms": response.get("latency_ms")}
+            with lock:
+                with open(manifest, "a") as fid:
+                    fid.write(json.dumps(record) + "\n")
+                if response["status"] == "ok":
+                    counts["ok"] += 1
+                else:
+                    counts["failed"] += 1
+                    print "%s failed: %s" % (f, response.get("error"))
+                pbar.update(1)
+        worker.stop()
+
+    threads = [threading.Thread(target = _work) for _ in range(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    pbar.close()
+
+    return counts["ok"], skipped, counts["failed"]
 
 
 def main(args):
@@ -80,10 +177,17 @@ def main(args):
     assert type(offx) is int, "Wrong offset_x type"
     assert type(offy) is int, "Wrong offset_y type"
     assert type(gpu) is bool, "Wrong gpu flag type"
+    assert args.workers > 0, "Needs at least one worker"
+
 
+    ok, skipped, failed = batch_demosaic_with_djdd(dir = mosaic_dir, output = output_dir, dem_bin = dem_bin,
+        model = model, offx = offx, offy = offy, gpu = gpu, workers = args.workers,
+        timeout = args.timeout, retries = args.retries, manifest = args.manifest,
+        backend = args.backend)
 
-    batch_demosaic_with_djdd(dir = mosaic_dir, output = output_dir, dem_bin = dem_bin,
-        model = model, offx = offx, offy = offy, gpu = gpu)
+    print "%d processed, %d skipped, %d failed" % (ok, skipped, failed)
+    if failed > 0:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -96,6 +200,11 @@ if __name__ == '__main__':
     parser.add_argument("--offx", default = 0, type = int, help = "Offset x to align mosaic")
     parser.add_argument("--offy", default = 0, type = int, help = "Offset y to align mosaic")
     parser.add_argument("--gpu", dest='gpu', action='store_true', help = "Use GPU to demosaic")
+    parser.add_argument("--backend", default = "caffe", choices = ["caffe", "numpy"], help = "Run the network with Caffe or with the Caffe-free numpy implementation")
+    parser.add_argument("--workers", default = 4, type = int, help = "Number of worker processes, each loads the model once")
+    parser.add_argument("--timeout", default = 600, type = int, help = "Seconds before a job is considered stuck and its worker restarted")
+    parser.add_argument("--retries", default = 1, type = int, help = "Number of times a failed job is retried")
+    parser.add_argument("--manifest", default = None, type = str, help = "Record of processed files used to resume (default: output_dir/batch_manifest.jsonl)")
     parser.add_argument("--verbose", dest='verbose', action='store_true', help = "Verbose output")
 
     args = parser.parse_args()
@@ -8,42 +8,161 @@ from PIL import Image
 from tqdm import tqdm
 
 import argparse
+import csv
+import multiprocessing
 import os
 import re
 import subprocess
-import threading
+import time
+from multiprocessing.pool import ThreadPool
 
-params = {}
+from to_mono import to_monochrome
 
-rgbg = "-r %.3f %.3f %.3f %.3f"
-dcraw_cmd = "dcraw%s -d -6 -T %s %s"
-libraw_cmd = "dcraw_emu %s -disinterp -6 -T -o 0 %s"
+params = {'DECODER': 'dcraw', 'W': False, 'r': None}
+
+# Decoders: dcraw and dcraw_emu (libraw) run as processes writing a tiff next to
+# the raw image, rawpy decodes the raw image in-process.
+DECODERS = ['dcraw', 'libraw', 'rawpy']
+RAW_EXTENSIONS = ['.arw', '.cr2', '.dng', '.nef', '.raf', '.rw2']
+
+dcraw_cmd = ["dcraw", "-d", "-6", "-T"]
+libraw_cmd = ["dcraw_emu", "-disinterp", "-6", "-T", "-o", "0"]
+
+MANIFEST = "conversion_manifest.csv"
+FAILURES = "conversion_failures.csv"
 
 def build_cmd(image_path):
-    global params, rgbg, dcraw_cmd, libraw_cmd
+    """Argument list of the decoder call, run without a shell."""
+    global params, dcraw_cmd, libraw_cmd
     DECODER = params['DECODER']
-    if params['W']:
-        W = ' -W'
-    else:
-        W = ''
 
     if params['r'] is not None:
         r = params['r']
-        rgb_mtplr = rgbg % (r[0], r[1], r[2], r[3])
+        rgb_mtplr = ["-r"] + ["%.3f" % v for v in r]
     else:
-        rgb_mtplr = ''
+        rgb_mtplr = []
 
     if DECODER == 'dcraw':
-        cmd = dcraw_cmd % (W, rgb_mtplr, re.escape(image_path))
+        if params['W']:
+            W = ['-W']
+        else:
+            W = []
+        cmd = dcraw_cmd[:1] + W + dcraw_cmd[1:] + rgb_mtplr + [image_path]
 
     elif DECODER == 'libraw':
-        cmd = libraw_cmd % (rgb_mtplr, re.escape(image_path))
+        cmd = libraw_cmd[:1] + rgb_mtplr + libraw_cmd[1:] + [image_path]
 
     else:
         raise NotImplementedError("Unindentifed decoder")
 
     return cmd
 
+def select_decoder(decoder, W = False, r = None, rgb = False):
+    """Set the decoder used by this module, rawpy falls back to dcraw if it is not installed.
+
+        Input:
+            rgb: raw images will be decoded over three channels, which dcraw cannot do:
+                 rawpy then falls back to libraw, and dcraw is refused
+
+        Return: the decoder selected
+    """
+    global params
+    if decoder not in DECODERS:
+        raise NotImplementedError("Unindentifed decoder")
+    if decoder == 'rawpy':
+        try:
+            import rawpy
+        except ImportError:
+            decoder = 'libraw' if rgb else 'dcraw'
+            print ("rawpy is not installed, falling back to %s." % decoder)
+    if rgb and decoder == 'dcraw':
+        raise NotImplementedError("dcraw mosaics are monochrome, use libraw or rawpy")
+    params['DECODER'] = decoder
+    params['W'] = W
+    params['r'] = r
+    return decoder
+
+def decode_rawpy(image_path, r = None, W = False, rgb = False):
+    """Decode the Bayer CFA of a raw image in-process with rawpy (LibRaw bindings)
+
+        Follows dcraw -d -6: black level removed and scaled to 16 bits, multiplied
+        by the rgbg multipliers r if given, auto brightened (1% of the pixels
+        saturated) unless W.
+
+        Input:
+            image_path: a single image path
+            rgb: spread the samples over three channels, as dcraw_emu -disinterp
+
+        Return:
+            (h, w), or (h, w, 3) with rgb, uint16 array
+    """
+    import rawpy
+
+    with rawpy.imread(image_path) as raw:
+        cfa = raw.raw_image_visible.astype(np.float32)
+        colors = raw.raw_colors_visible.copy()
+        black = np.array(raw.black_level_per_channel, dtype = np.float32)
+        white = float(raw.white_level)
+        channels = np.array(["RGB".index(c) for c in raw.color_desc.decode()])
+
+    cfa -= black[colors]
+    cfa *= 65535.0 / (white - black[colors])
+    if r is not None:
+        cfa *= np.array(r, dtype = np.float32)[colors]
+    if not W:
+        cfa *= 65535.0 / max(np.percentile(cfa, 99), 1.0)
+    cfa = np.clip(cfa, 0, 65535).astype(np.uint16)
+
+    if not rgb:
+        return cfa
+    out = np.zeros(cfa.shape + (3,), dtype = np.uint16)
+    channel = channels[colors]
+    for c in range(3):
+        out[..., c][channel == c] = cfa[channel == c]
+    return out
+
+def decode_raw(image_path, rgb = False, bits = 16):
+    """Decode the mosaic of a raw image into an array with the selected decoder
+
+        Only the command line decoders go through a (deleted) tiff file.
+
+        Input:
+            image_path: a single image path
+            rgb: samples spread over three channels instead of a monochrome mosaic
+            bits: 16, or 8 to keep the most significant byte
+
+        Return:
+            (h, w) or (h, w, 3) array
+    """
+
+    DECODER = params['DECODER']
+    if DECODER == 'rawpy':
+        im = decode_rawpy(image_path, params['r'], params['W'], rgb)
+    else:
+        _, code, _, err = convert_into_mosaic(image_path)
+        if code != 0:
+            raise IOError("Failed to decode %s: %s" % (image_path, err))
+        path = tiff_path(image_path)
+        im = np.array(Image.open(path))
+        os.remove(path)
+        if len(im.shape) == 3 and not rgb:
+            im = to_monochrome(im)
+        elif len(im.shape) == 2 and rgb:
+            raise NotImplementedError("dcraw mosaics are monochrome, use libraw or rawpy")
+
+    if bits == 8:
+        im = (im >> 8).astype(np.uint8)
+    return im
+
+def tiff_path(image_path):
+    """Path of the tiff the decoder writes next to the raw image."""
+    if params['DECODER'] == 'libraw':
+        return image_path + ".tiff"
+    return os.path.splitext(image_path)[0] + ".tiff"
+
+def is_newer(path, than):
+    return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(than)
+
 def convert_into_mosaic(image_path):
     """Convert the image into mosaic with libraw:
         Input:
@@ -56,12 +175,28 @@ def convert_into_mosaic(image_path):
             dcraw_emu -r 1 1 1 1 -disinterp -6 -T -o 0
 
         Return:
-            code, return code of dcraw_emu. non zero on error.
+            (image_path, code, seconds, error): return code of the decoder, non zero
+            on error, decoding time and its error output.
     """
 
-    cmd = build_cmd(image_path)
-    code = subprocess.call(cmd, shell=True)
-    return code
+    start = time.time()
+    if params['DECODER'] == 'rawpy':
+        try:
+            Image.fromarray(decode_rawpy(image_path, params['r'], params['W'])).save(tiff_path(image_path))
+            return image_path, 0, time.time() - start, ""
+        except Exception as e:
+            return image_path, -1, time.time() - start, str(e)
+
+    try:
+        proc = subprocess.Popen(build_cmd(image_path), stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        _, err = proc.communicate()
+        code = proc.returncode
+        err = err.decode(errors = 'replace').strip()
+    except OSError as e:
+        code, err = -1, str(e)
+    if code == 0 and not os.path.exists(tiff_path(image_path)):
+        code, err = -1, "no output written"
+    return image_path, code, time.time() - start, err
 
 def batch_convert(image_path_list):
     """Iterate image path list and apply dcraw_emu conversion of the images:
@@ -75,57 +210,103 @@ def batch_convert(image_path_list):
     for img in tqdm(image_path_list):
             c = convert_into_mosaic(img)
 
-def batch_convert_multi(image_path_list):
+def batch_convert_multi(image_path_list, workers = None):
     """Iterate image path list and apply dcraw_emu conversion of the images: (multi_threaded)
+
+        Decoders run as separate processes, driven by a pool of threads sized to
+        the number of cores. Images whose tiff is already newer than the raw file
+        are not decoded again.
+
         Input:
             image_path_list: a list of images to convert, in full fs path
+            workers: number of concurrent decoders, defaults to the number of cores
         Calls:
             convert_into_mosaic()
         Return:
-            None
+            results: dict image path -> (code, seconds, error)
     """
 
-    max_thread = 32
-
-    print ("Starting to convert.")
-    for img in tqdm(image_path_list):
-        while (threading.active_count() > max_thread):
-            pass #Wait till some thread finishes.
-
-        t = threading.Thread(target = convert_into_mosaic, args = (img, ))
-        t.start()
-
-    while(threading.active_count() > 1):
-        pass #Wait till all thread finishes.
-
-
-def move_to_dst(img_list, dst, cn):
+    results = {}
+    todo = []
+    for img in image_path_list:
+        if is_newer(tiff_path(img), img):
+            results[img] = (0, 0.0, "")
+        else:
+            todo.append(img)
+
+    print ("Starting to convert %d images, %d already decoded." % (len(todo), len(results)))
+    if not todo:
+        return results
+
+    pool = ThreadPool(workers or multiprocessing.cpu_count())
+    with tqdm(total = len(todo)) as pbar:
+        for img, code, seconds, err in pool.imap_unordered(convert_into_mosaic, todo):
+            results[img] = (code, seconds, err)
+            if code != 0:
+                print ("Failed to convert %s (%d): %s" % (img, code, err))
+            pbar.update(1)
+    pool.close()
+    pool.join()
+
+    times = [results[img][1] for img in todo if results[img][0] == 0]
+    if times:
+        print ("Decode time per file: mean %.2fs, max %.2fs" % (np.mean(times), np.max(times)))
+
+    return results
+
+
+def read_manifest(dst):
+    """Outputs recorded by earlier runs, dict source -> (output, seconds)."""
+    manifest = {}
+    path = os.path.join(dst, MANIFEST)
+    if os.path.exists(path):
+        with open(path) as f:
+            for row in csv.reader(f):
+                if len(row) == 3:
+                    manifest[row[0]] = (row[1], row[2])
+    return manifest
+
+def is_converted(img, manifest):
+    """Whether the output recorded for img is newer than it."""
+    return img in manifest and is_newer(manifest[img][0], img)
+
+def record_failures(dst, failures):
+    """Write the (source, code, error) failures of this run next to the outputs."""
+    with open(os.path.join(dst, FAILURES), "w") as f:
+        writer = csv.writer(f)
+        for row in failures:
+            writer.writerow(row)
+    if failures:
+        print ("%d images failed, see %s" % (len(failures), os.path.join(dst, FAILURES)))
+
+
+def move_to_dst(img_list, dst, cn, results = None):
     """Move all mosaic image to dst folder
         Input:
-            img_list: list of images that needed to be moved
+            img_list: list of raw images whose mosaic needs to be moved
             dst: destination folder, specified in output parameter
             cn: clean/noisy indicator
+            results: decoding results of batch_convert_multi, recorded in the manifest
         Output:
             None
     """
 
-    n = 0
-    for _, _, files in os.walk(dst):
-        n = len(files)
-
-    filename = ""
+    manifest = read_manifest(dst)
+    n = len([f for f in os.listdir(dst) if f.startswith(cn) and f.endswith(".tiff")])
 
     print ("Moving outputs to destination.")
-    for i in tqdm(img_list):
-        # filename = i.split("/")[-1]
-        if cn == 'c':
-            filename = "c%s.tiff" % str(n).zfill(6)
-        elif cn == 'n':
-            filename = "n%s.tiff" % str(n).zfill(6)
-        elif cn == 't':
-            filename = "t%s.tiff" % str(n).zfill(6)
-        os.rename(i, dst+filename)
-        n+=1
+    with open(os.path.join(dst, MANIFEST), "a") as f:
+        writer = csv.writer(f)
+        for i in tqdm(img_list):
+            if i in manifest:
+                # Updated raw image, replaces its previous output
+                output = manifest[i][0]
+            else:
+                output = dst + "%s%s.tiff" % (cn, str(n).zfill(6))
+                n += 1
+            os.rename(tiff_path(i), output)
+            seconds = results[i][1] if results is not None else 0
+            writer.writerow([i, output, "%.3f" % seconds])
 
 
 def get_file_list(dir, regex=None):
@@ -168,6 +349,9 @@ def main(args):
         print ("Using libraw as raw decoder.")
         params['DECODER'] = 'libraw'
 
+    elif args.rawpy and select_decoder('rawpy') == 'rawpy':
+        print ("Using rawpy as raw decoder.")
+
     else:
     	print ("Using dcraw as raw decoder.")
     	params['DECODER'] = 'dcraw'
@@ -214,18 +398,25 @@ def main(args):
         if not len(cimage_list) == len(nimage_list):
             raise Exception("Sanity check: File counts mismatch of %s" % src)
 
-        batch_convert_multi(cimage_list)
-        batch_convert_multi(nimage_list)
+        # Pairs already converted by an earlier run are skipped
+        cmanifest = read_manifest(cout)
+        nmanifest = read_manifest(nout)
+        pairs = [(c, n) for c, n in zip(cimage_list, nimage_list)
+                 if not (is_converted(c, cmanifest) and is_converted(n, nmanifest))]
+        print ("%d pairs to convert, %d up to date." % (len(pairs), len(cimage_list) - len(pairs)))
 
-        tiffregex = re.compile(r'.*\.tiff')
-        coutput_list = get_file_list(csrc, tiffregex)
-        noutput_list = get_file_list(nsrc, tiffregex)
+        cresults = batch_convert_multi([c for c, _ in pairs if not is_converted(c, cmanifest)], args.workers)
+        nresults = batch_convert_multi([n for _, n in pairs if not is_converted(n, nmanifest)], args.workers)
 
-        if not len(coutput_list) == len(noutput_list):
-            raise Exception("Sanity check: Mosaic files counts mismatch")
+        # Only complete pairs are moved, so clean and noisy outputs stay aligned
+        converted = [(c, n) for c, n in pairs
+                     if cresults.get(c, (0,))[0] == 0 and nresults.get(n, (0,))[0] == 0]
+        failures = [(i, code, err) for results in [cresults, nresults]
+                    for i, (code, _, err) in sorted(results.items()) if code != 0]
+        record_failures(out, failures)
 
-        move_to_dst(coutput_list, cout, 'c')
-        move_to_dst(noutput_list, nout, 'n')
+        move_to_dst([c for c, _ in converted if c in cresults], cout, 'c', cresults)
+        move_to_dst([n for _, n in converted if n in nresults], nout, 'n', nresults)
 
     else:
         # Converting test set
@@ -237,12 +428,15 @@ def main(args):
         arwregex = re.compile(r'.*\.ARW')
         image_list = get_file_list(src, arwregex)
 
-        batch_convert_multi(image_list)
+        manifest = read_manifest(out)
+        image_list = [i for i in image_list if not is_converted(i, manifest)]
+
+        results = batch_convert_multi(image_list, args.workers)
 
-        tiffregex = re.compile(r'.*\.tiff')
-        output_list = get_file_list(src, tiffregex)
+        failures = [(i, code, err) for i, (code, _, err) in sorted(results.items()) if code != 0]
+        record_failures(out, failures)
 
-        move_to_dst(output_list, out, 't')
+        move_to_dst([i for i in image_list if results[i][0] == 0], out, 't', results)
 
 
 if __name__ == '__main__':
@@ -252,8 +446,10 @@ if __name__ == '__main__':
     parser.add_argument('output', type = str, help = "Directory to mosaic tiff output.")
     parser.add_argument('--test', dest='test', action='store_true', help = "If defined, will only batch convert single folder.")
     parser.add_argument('--libraw', dest='libraw', action='store_true', help = "Use dcraw_emu instead of dcraw to convert.")
+    parser.add_argument('--rawpy', dest='rawpy', action='store_true', help = "Decode in-process with rawpy, falls back to dcraw if it is not installed.")
     parser.add_argument('--W', dest='W', action='store_true', help='Don\'t auto brighten image')
     parser.add_argument('--r', type = float,nargs=4, help = 'Use specified rgbg multipliers.')
+    parser.add_argument('--workers', type = int, help = 'Number of concurrent decoders, defaults to the number of cores.')
 
     args = parser.parse_args()
 
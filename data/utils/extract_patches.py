@@ -6,16 +6,96 @@ from __future__ import print_function
 import numpy as np
 from PIL import Image
 from sklearn.feature_extraction import image
+from numpy.lib.stride_tricks import as_strided
 from tqdm import tqdm
 
 import argparse
+import csv
+import multiprocessing
 import os
-import threading
 
-def sample_patches_2d(img, shape, num_patches, offset_x = 0, offset_y = 0, random_seed = 0):
+import convert_into_mosaic as raw_decoder
+
+# Times near-flat patches are redrawn before being accepted anyway
+MAX_FLAT_REDRAWS = 10
+
+def patch_grid_2d(img, shape, offset_x = 0, offset_y = 0):
+    """Strided view of the patches whose corners are on even coordinates plus the offsets
+
+        Stepping by 2 keeps the phase of the mosaic. No data is copied.
+
+        Input:
+            img: image, either tri-chromatic (:,:,3), or mono-chromatic (:,:)
+            shape: shape of the patches, tuple of two ints (h, w)
+            offset_x, offset_y: offset of the first corner
+        Output:
+            grid: view of shape (rows, cols, h, w) or (rows, cols, h, w, 3), the patch
+                  at (j, i) has its upper left corner at (offset_x + 2i, offset_y + 2j)
+
+    """
+
+    sh, sw = shape
+    assert type(sh) is int and type(sw) is int, "Error parsing shape"
+
+    ih, iw = img.shape[0], img.shape[1]
+    rows = len(range(offset_y, ih - sh, 2))
+    cols = len(range(offset_x, iw - sw, 2))
+    assert rows > 0 and cols > 0, "Image %s too small for patches of %s" % (str(img.shape), str(shape))
+
+    corner = img[offset_y:, offset_x:]
+    strides = (2 * corner.strides[0], 2 * corner.strides[1]) + corner.strides
+    return as_strided(corner, (rows, cols, sh, sw) + img.shape[2:], strides)
+
+def sample_locations_2d(img, shape, num_patches, offset_x = 0, offset_y = 0, random_seed = 0, min_std = 0):
+    """Draw the upper left corners of patches at random
+
+        Corners are on even coordinates (plus the offsets) to keep the mosaic phase.
+        With min_std > 0, patches of img whose standard deviation is below it are
+        redrawn (at most MAX_FLAT_REDRAWS times).
+
+        Input:
+            img, shape, num_patches, offset_x, offset_y, random_seed, min_std: as sample_patches_2d
+        Output:
+            x, y: arrays of num_patches corner coordinates
+
+    """
+
+    grid = patch_grid_2d(img, shape, offset_x, offset_y)
+    rows, cols = grid.shape[:2]
+
+    rng = np.random.RandomState(random_seed)
+    i = rng.randint(0, cols, num_patches)
+    j = rng.randint(0, rows, num_patches)
+
+    if min_std > 0:
+        todo = np.arange(num_patches)
+        for _ in range(MAX_FLAT_REDRAWS):
+            patches = grid[j[todo], i[todo]]
+            todo = todo[patches.reshape(len(todo), -1).std(axis = 1) < min_std]
+            if len(todo) == 0:
+                break
+            i[todo] = rng.randint(0, cols, len(todo))
+            j[todo] = rng.randint(0, rows, len(todo))
+
+    return offset_x + 2 * i, offset_y + 2 * j
+
+def gather_patches_2d(img, shape, x, y, offset_x = 0, offset_y = 0):
+    """Copy the patches at corners (x, y), drawn by sample_locations_2d, in one operation
+
+        Output:
+            patches: an array of patches of shape (len(x), shape) or (len(x), shape, 3)
+
+    """
+
+    grid = patch_grid_2d(img, shape, offset_x, offset_y)
+    return grid[(y - offset_y) // 2, (x - offset_x) // 2]
+
+def sample_patches_2d(img, shape, num_patches, offset_x = 0, offset_y = 0, random_seed = 0, min_std = 0):
     """Overriding sklearn.feature_extraction.image.extract_patches_2d
 
         Extract patches from a mono/tri chromatic image at random, or at a given location.
+        To sample the same locations in a pair of images, use sample_locations_2d on one
+        and gather_patches_2d on both.
 
         Input:
             img: image, either tri-chromatic (:,:,3), or mono-chromatic (:,:,1)
@@ -24,41 +104,30 @@ def sample_patches_2d(img, shape, num_patches, offset_x = 0, offset_y = 0, rando
             offset_x: make offset on x axis
             offset_y: make offset on y axis
             random_seed: seed to extract the image into
+            min_std: redraw patches whose standard deviation is below it
         Output:
             patches: an array of patches of shape (num_patches, shape, 3) or (num_patches, shape, 1)
 
     """
 
-    assert len(img.shape) == 2 or img.shape[2] == 3, "Image dimension mismatch, should be mono or tri chromatic, %s" % str(image.shape)
-
-    # Patch height and width
-    sh, sw = shape
-    assert type(sh) is int and type(sw) is int, "Error parsing shape"
+    assert len(img.shape) == 2 or img.shape[2] == 3, "Image dimension mismatch, should be mono or tri chromatic, %s" % str(img.shape)
 
-    # Image height and width
-    ih, iw = img.shape[0], img.shape[1]
-
-    # Effective height and width to sample at
-    eh = ih - sh
-    ew = iw - sw
-    hl = np.arange(eh)[0::2].astype(int)
-    wl = np.arange(ew)[0::2].astype(int)
-    hl += offset_y
-    wl += offset_x
+    x, y = sample_locations_2d(img, shape, num_patches, offset_x, offset_y, random_seed, min_std)
+    return gather_patches_2d(img, shape, x, y, offset_x, offset_y)
 
-    np.random.seed(random_seed)
+def sample_patch_pairs_2d(noisy_img, clean_img, shape, num_patches, offset_x = 0, offset_y = 0, random_seed = 0, min_std = 0):
+    """Sample patches at the same random locations of a noisy and a clean image
 
-    x = np.random.choice(wl, num_patches)
-    y = np.random.choice(hl, num_patches)
-    ats = list(zip(x, y))
+        Flat patches are judged on the clean image.
 
-    patches = []
-    for at in ats:
-        patches.append(extract_single_patch_2d_at(img, shape, at))
-
-    patches = np.array(patches)
+        Output:
+            x, y, patches_n, patches_c
+    """
 
-    return patches
+    x, y = sample_locations_2d(clean_img, shape, num_patches, offset_x, offset_y, random_seed, min_std)
+    patches_n = gather_patches_2d(noisy_img, shape, x, y, offset_x, offset_y)
+    patches_c = gather_patches_2d(clean_img, shape, x, y, offset_x, offset_y)
+    return x, y, patches_n, patches_c
 
 def extract_single_patch_2d_at(img, shape, at):
     """Extract an image patch from certain location of the given image.
@@ -91,90 +160,143 @@ def extract_single_patch_2d_at(img, shape, at):
     return patch
 
 
-def extract_patches_multi(Noisy_List, Clean_List, Noisy_out = './Images/NoisyPatches/', Clean_out = './Images/CleanPatches/',
-                            patches_per_image = 10, patch_shape = (128 ,128), offset_x = 0, offset_y = 0):
-    """Extract Images into patches (Multi-threaded ver.)
+def is_raw(path):
+    return os.path.splitext(path)[1].lower() in raw_decoder.RAW_EXTENSIONS
 
-        Input:
-            Noisy_List, Clean_List: A list of filenames for noisy and clean images
-            Noisy_out, Clean_out: Output directory for noisy and clean patches
 
-        File Output:
-            Patches of file written to Noisy_out and Clean_out
+def load_image(path, rgb = False, bits = 8):
+    """Read an image, raw images are decoded in memory by convert_into_mosaic.decode_raw
+
+        Input:
+            path: image path
+            rgb: for raw images, spread the mosaic over three channels (clean references)
+            bits: depth of decoded raw images, 8 (written to tiff patches) or 16
 
         Return:
-            None
+            image array, other images keep the dtype they are read with
     """
 
-    assert len(Noisy_List) == len(Clean_List), "Sanity Check: Noisy, Clean images list length mismatch"
+    if is_raw(path):
+        return raw_decoder.decode_raw(path, rgb = rgb, bits = bits)
+    return np.array(Image.open(path))
 
-    existing_patches_n = get_file_list(Noisy_out)
-    existing_patches_c = get_file_list(Clean_out)
+def _extract_pair(job):
+    """Worker of extract_patches_multi: samples the patches of one image pair.
 
-    if not len(existing_patches_c) == len(existing_patches_n):
-        raise IOError("Existing file count mismatch in output folder, possibility of mismatch of ref.")
+        Return: (x, y, noisy patches, clean patches), or an error message
+    """
+    Noisy, Clean, patches_per_image, patch_shape, offset_x, offset_y, random_seed, min_std = job
 
-    count_base = len(existing_patches_c)
-    print ("Output Folder Index Starting from %d" % count_base)
+    try:
+        clean_img = load_image(Clean, rgb = True)
+        noisy_img = load_image(Noisy)
+    except Exception as e:
+        return "%s: %s" % (Noisy, e)
 
-    """Function onto worker thread:
-        Input:
-            Noisy, Clean: Path for Clean Images
-            local_c: local variable in place of count
-            local_i: local variable in place of i
+    if not (clean_img.shape[0] == noisy_img.shape[0] and clean_img.shape[1] == noisy_img.shape[1]):
+        return "Clean(%s) and Noisy(%s) image size mismatch" % (Clean, Noisy)
+
+    return sample_patch_pairs_2d(noisy_img, clean_img, patch_shape, patches_per_image,
+                                 offset_x, offset_y, random_seed, min_std)
+
+
+def read_manifest(manifest):
+    """Read the patches recorded by extract_patches_multi
 
-        Assumption:
-            count_base, Noisy_out, Clean_out, patches_per_image, patch_shape does not
-            change through out the extraction.
+        Return: list of (index, noisy, clean, x, y) rows
     """
-    def _extract(Noisy, Clean, local_i, random_seed):
 
-        clean_img = np.array(Image.open(Clean))
-        noisy_img = np.array(Image.open(Noisy))
+    if not os.path.exists(manifest):
+        return []
+    rows = []
+    with open(manifest) as f:
+        for row in list(csv.reader(f))[1:]:
+            try:
+                i, n, c, x, y = row
+                rows.append((int(i), n, c, int(x), int(y)))
+            except ValueError:
+                continue  # Truncated by an interrupted run
+    return rows
 
-        try:
-            if not (clean_img.shape[0] == noisy_img.shape[0] and clean_img.shape[1] == noisy_img.shape[1]):
-                raise ValueError("Clean(%s) and Noisy(%s) image size mismatch" % (Clean_List[i], Noisy_List[i]))
-        except ValueError as e:
-            print (e)
-            return
 
-        patches_c = sample_patches_2d(clean_img, patch_shape, patches_per_image, offset_x, offset_y, random_seed)
-        patches_n = sample_patches_2d(noisy_img, patch_shape, patches_per_image, offset_x, offset_y, random_seed)
+def extract_patches_multi(Noisy_List, Clean_List, Noisy_out = './Images/NoisyPatches/', Clean_out = './Images/CleanPatches/',
+                            patches_per_image = 10, patch_shape = (128 ,128), offset_x = 0, offset_y = 0,
+                            workers = None, manifest = None, min_std = 0):
+    """Extract Images into patches (Multi-process ver.)
 
-        try:
-            if not patches_c.shape[0] == patches_per_image and patches_n.shape[0] == patches_per_image:
-                raise ValueError("Extracted Patches number mismatch: clean(%s), noisy(%s), patches_per_image(%s)" % (str(patches_c.shape[0]), str(patches_n.shape[0], str(patches_per_image))))
-        except ValueError:
-            return
+        Image pairs are decoded and sampled by a pool of worker processes. The
+        patches are written in input order with contiguous indices, so a pair
+        that cannot be read leaves no hole, and each is recorded in the manifest
+        as (index, noisy, clean, x, y). Pairs already in the manifest are
+        skipped, so an interrupted run can be resumed by running it again.
 
-        for n in range(patches_c.shape[0]):
-            name_c = "c" + str(count_base + local_i + n).zfill(7) + ".tiff"
-            name_n = "n" + str(count_base + local_i + n).zfill(7) + ".tiff"
+        Input:
+            Noisy_List, Clean_List: A list of filenames for noisy and clean images
+            Noisy_out, Clean_out: Output directory for noisy and clean patches
+            workers: number of worker processes, defaults to the number of cores
+            manifest: csv file recording the patches, defaults to patches_manifest.csv
+                      next to Clean_out
+            min_std: redraw clean patches whose standard deviation is below it
 
-            Image.fromarray(patches_c[n]).save(Clean_out + name_c)
-            Image.fromarray(patches_n[n]).save(Noisy_out + name_n)
+        File Output:
+            Patches of file written to Noisy_out and Clean_out
 
-    random_state = np.random.randint(0, 10000, 1)
-    max_thread = 28
+        Return:
+            None
+    """
 
-    with tqdm(total = len(Noisy_List), desc = "Extracting Patches", unit = 'frames') as pbar:
-        for i in range(len(Noisy_List)):
+    assert len(Noisy_List) == len(Clean_List), "Sanity Check: Noisy, Clean images list length mismatch"
 
-            # Block for too many threads created, no racing condition here.
-            while (threading.active_count() > max_thread):
-                pass
+    if manifest is None:
+        manifest = os.path.join(os.path.dirname(os.path.normpath(Clean_out)), "patches_manifest.csv")
 
-            random_state += 1
-            threading.Thread(target = _extract, args = (Noisy_List[i], Clean_List[i], i * patches_per_image, random_state)).start()
+    rows = read_manifest(manifest)
+    if rows:
+        # Patches past the manifest are from an interrupted image, they are overwritten
+        count = rows[-1][0] + 1
+        done = set((n, c) for _, n, c, _, _ in rows)
+    else:
+        existing_patches_n = get_file_list(Noisy_out)
+        existing_patches_c = get_file_list(Clean_out)
 
-            pbar.update(1)
+        if not len(existing_patches_c) == len(existing_patches_n):
+            raise IOError("Existing file count mismatch in output folder, possibility of mismatch of ref.")
 
-    # Hold till all threads finishes.
-    while(threading.active_count() > 1):
-        pass
+        count = len(existing_patches_c)
+        done = set()
+    print ("Output Folder Index Starting from %d" % count)
 
-    pbar.close()
+    random_state = np.random.randint(0, 10000)
+    jobs = [(Noisy_List[i], Clean_List[i], patches_per_image, patch_shape, offset_x, offset_y, random_state + i, min_std)
+            for i in range(len(Noisy_List)) if (Noisy_List[i], Clean_List[i]) not in done]
+
+    new_manifest = not os.path.exists(manifest)
+    pool = multiprocessing.Pool(workers)
+    with open(manifest, "a") as f:
+        writer = csv.writer(f)
+        if new_manifest:
+            writer.writerow(["index", "noisy", "clean", "x", "y"])
+
+        with tqdm(total = len(jobs), desc = "Extracting Patches", unit = 'frames') as pbar:
+            for i, result in enumerate(pool.imap(_extract_pair, jobs)):
+                pbar.update(1)
+                job = jobs[i]
+                if isinstance(result, str):
+                    print (result)
+                    continue
+
+                x, y, patches_n, patches_c = result
+                for n in range(len(patches_c)):
+                    name = str(count + n).zfill(7) + ".tiff"
+                    Image.fromarray(patches_c[n]).save(Clean_out + "c" + name)
+                    Image.fromarray(patches_n[n]).save(Noisy_out + "n" + name)
+                for n in range(len(patches_c)):
+                    writer.writerow([count + n, job[0], job[1], x[n], y[n]])
+                f.flush()
+                count += len(patches_c)
+
+    pool.close()
+    pool.join()
 
 
 def extract_patches(Noisy_List, Clean_List, Noisy_out = './Images/NoisyPatches/', Clean_out = './Images/CleanPatches/',
@@ -206,8 +328,8 @@ def extract_patches(Noisy_List, Clean_List, Noisy_out = './Images/NoisyPatches/'
     random_state = np.random.randint(0, 10000, 1)
     with tqdm(total = len(Noisy_List), desc = "Extracting Patches", unit = 'frames') as pbar:
         for i in range(len(Noisy_List)):
-            clean_img = np.array(Image.open(Clean_List[i]))
-            noisy_img = np.array(Image.open(Noisy_List[i]))
+            clean_img = load_image(Clean_List[i], rgb = True)
+            noisy_img = load_image(Noisy_List[i])
 
             try:
                 if not (clean_img.shape[0] == noisy_img.shape[0] and clean_img.shape[1] == noisy_img.shape[1]):
@@ -216,8 +338,8 @@ def extract_patches(Noisy_List, Clean_List, Noisy_out = './Images/NoisyPatches/'
                 print (e)
                 continue
 
-            patches_c = sample_patches_2d(clean_img, patch_shape, patches_per_image, offset_x, offset_y, random_state)
-            patches_n = sample_patches_2d(noisy_img, patch_shape, patches_per_image, offset_x, offset_y, random_state)
+            _, _, patches_n, patches_c = sample_patch_pairs_2d(noisy_img, clean_img, patch_shape, patches_per_image,
+                                                               offset_x, offset_y, random_state)
 
             for j in range(patches_c.shape[0]):
                 name = "c" + str(count).zfill(7) + ".tiff"
@@ -231,6 +353,143 @@ def extract_patches(Noisy_List, Clean_List, Noisy_out = './Images/NoisyPatches/'
         pbar.close()
 
 
+class LmdbPatchWriter(object):
+    """Appends patches to a lmdb database as Datums under sequential keys.
+
+    Mirrors the append/flush interface of demosaicnet.patchstore.PatchStore.
+    """
+
+    def __init__(self, path, capacity, shape, dtype = np.uint8):
+        import lmdb
+
+        if dtype != np.uint8:
+            raise ValueError("Datums hold %s patches as floats, which the lmdb data layer cannot scale, "
+                             "use a patch store" % np.dtype(dtype).name)
+        self.dtype = np.dtype(dtype)
+        record_bytes = int(np.prod(shape)) * self.dtype.itemsize
+        self.env = lmdb.open(path, map_size = 2 * capacity * record_bytes + (1 << 26))
+        with self.env.begin() as txn:
+            self.count = txn.stat()['entries']
+        self.pending = []
+
+    def __len__(self):
+        return self.count + len(self.pending)
+
+    def append(self, patches):
+        start = len(self)
+        self.pending.extend(patches)
+        return start
+
+    def flush(self):
+        import caffe
+
+        count = self.count
+        with self.env.begin(write = True) as txn:
+            for patch in self.pending:
+                key = "{:010d}".format(count).encode()
+                if not txn.put(key, caffe.io.array_to_datum(patch).SerializeToString(), append = True):
+                    raise ValueError("Key %s is not increasing." % key)
+                count += 1
+        self.count = count
+        self.pending = []
+
+    def close(self):
+        self.env.close()
+
+
+def extract_patches_to_store(Noisy_List, Clean_List, output, store = "patchstore", patches_per_image = 10,
+                             patch_shape = (128, 128), offset_x = 0, offset_y = 0, batch_size = 1000,
+                             shuffle_buffer = 4096, random_seed = 0, min_std = 0):
+    """Extract patch pairs straight into a patch store or a lmdb database
+
+        Each record holds a noisy monochrome patch and its clean RGB patch
+        (4 channels, as bin/convert_to_lmdb --groundtruth), no image file is
+        written per patch. Records keep the depth of the images, 16 bits
+        for raw images, and the store is created with the dtype of the first
+        pair; only patch stores take 16 bits records. Images are read one at a time and records are
+        committed every batch_size patches. Patches go through a buffer of
+        shuffle_buffer records, drawn at random, so that consecutive records
+        mostly come from different images; memory is bounded by that buffer.
+
+        Input:
+            Noisy_List, Clean_List: A list of filenames for noisy (monochrome) and clean (RGB) images
+            output: Path of the patch store or lmdb database
+            store: "patchstore" or "lmdb"
+            min_std: redraw clean patches whose standard deviation is below it
+
+        Return:
+            number of patches written
+    """
+
+    assert len(Noisy_List) == len(Clean_List), "Sanity Check: Noisy, Clean images list length mismatch"
+
+    if store not in ["patchstore", "lmdb"]:
+        raise ValueError("Unknown store %s" % store)
+    shape = (4, patch_shape[0], patch_shape[1])
+    capacity = len(Noisy_List) * patches_per_image
+    writer = None  # Created with the dtype of the first image pair
+
+    rng = np.random.RandomState(random_seed)
+    buffer = []
+    records = []
+
+    def _emit(record):
+        records.append(record)
+        if len(records) == batch_size:
+            writer.append(records)
+            writer.flush()
+            del records[:]
+
+    with tqdm(total = len(Noisy_List), desc = "Extracting Patches", unit = 'frames') as pbar:
+        for i in range(len(Noisy_List)):
+            clean_img = load_image(Clean_List[i], rgb = True, bits = 16)
+            noisy_img = load_image(Noisy_List[i], bits = 16)
+            pbar.update(1)
+
+            if not (clean_img.shape[0] == noisy_img.shape[0] and clean_img.shape[1] == noisy_img.shape[1]):
+                print("Clean(%s) and Noisy(%s) image size mismatch" % (Clean_List[i], Noisy_List[i]))
+                continue
+            if len(noisy_img.shape) != 2 or len(clean_img.shape) != 3 or clean_img.shape[2] != 3:
+                print("Noisy(%s) should be monochrome and Clean(%s) RGB" % (Noisy_List[i], Clean_List[i]))
+                continue
+            if noisy_img.dtype != clean_img.dtype or noisy_img.dtype not in [np.uint8, np.uint16]:
+                print("Noisy(%s) and Clean(%s) should both be 8 or 16 bits" % (Noisy_List[i], Clean_List[i]))
+                continue
+
+            if writer is None:
+                if store == "patchstore":
+                    from demosaicnet.patchstore import PatchStore
+                    writer = PatchStore.create(output, capacity, shape, dtype = noisy_img.dtype, paired = True)
+                else:
+                    writer = LmdbPatchWriter(output, capacity, shape, dtype = noisy_img.dtype)
+            elif noisy_img.dtype != writer.dtype:
+                print("Noisy(%s) and Clean(%s) are not of type %s" % (Noisy_List[i], Clean_List[i], writer.dtype))
+                continue
+
+            _, _, patches_n, patches_c = sample_patch_pairs_2d(noisy_img, clean_img, patch_shape, patches_per_image,
+                                                               offset_x, offset_y, random_seed + i, min_std)
+
+            for n in range(patches_c.shape[0]):
+                buffer.append(np.concatenate([patches_n[n][np.newaxis], patches_c[n].transpose((2, 0, 1))]))
+                if len(buffer) > shuffle_buffer:
+                    j = rng.randint(len(buffer))
+                    buffer[j], buffer[-1] = buffer[-1], buffer[j]
+                    _emit(buffer.pop())
+
+    if writer is None:
+        raise ValueError("No valid image pair to extract patches from")
+    rng.shuffle(buffer)
+    for record in buffer:
+        _emit(record)
+    if records:
+        writer.append(records)
+        writer.flush()
+
+    if store == "lmdb":
+        writer.close()
+    return len(writer)
+
+
 def get_file_list(dir):
     """Get List of files from directory
 
@@ -263,6 +522,25 @@ def main(args):
     ox = args.offset_x
     oy = args.offset_y
 
+    ppi = args.Patches_per_image
+    pw = args.Patch_width
+
+    Noisy_List = get_file_list(Noisy_dir)
+    Clean_List = get_file_list(Clean_dir)
+
+    # Raw clean references are decoded over three channels
+    raw_decoder.select_decoder(args.decoder, rgb = any(is_raw(p) for p in Clean_List))
+
+    if args.patchstore or args.lmdb:
+        if args.patchstore:
+            n = extract_patches_to_store(Noisy_List, Clean_List, args.patchstore, "patchstore", ppi, (pw, pw), ox, oy,
+                                         min_std = args.min_std)
+        else:
+            n = extract_patches_to_store(Noisy_List, Clean_List, args.lmdb, "lmdb", ppi, (pw, pw), ox, oy,
+                                         min_std = args.min_std)
+        print("%d patches written" % n)
+        return
+
     if not os.path.exists(Noisy_output):
         print ("Creating ", Noisy_output)
         os.mkdir(Noisy_output)
@@ -271,13 +549,8 @@ def main(args):
         print ("Creating ", Clean_output)
         os.mkdir(Clean_output)
 
-    ppi = args.Patches_per_image
-    pw = args.Patch_width
-
-    Noisy_List = get_file_list(Noisy_dir)
-    Clean_List = get_file_list(Clean_dir)
-
-    extract_patches_multi(Noisy_List, Clean_List, Noisy_output, Clean_output, ppi, (pw, pw), ox, oy)
+    extract_patches_multi(Noisy_List, Clean_List, Noisy_output, Clean_output, ppi, (pw, pw), ox, oy,
+                          args.workers, args.manifest, args.min_std)
     # extract_patches(Noisy_List, Clean_List, Noisy_output, Clean_output, ppi, (pw, pw), ox, oy)
 
 if __name__ == '__main__':
@@ -291,6 +564,12 @@ if __name__ == '__main__':
     parser.add_argument('--Patch_width', '-pw', type = int, help = "Width of patch, which is square", default = 128)
     parser.add_argument('--offset_x', '-ox', type = int, help = "x offset to align mosaic", default = 0)
     parser.add_argument('--offset_y', '-oy', type = int, help = "y offset to align mosaic", default = 0)
+    parser.add_argument('--decoder', type = str, choices = raw_decoder.DECODERS, help = "Decoder of raw input images (rawpy falls back to dcraw, or libraw for raw clean images)", default = "rawpy")
+    parser.add_argument('--min_std', type = float, help = "Redraw clean patches whose standard deviation is below this (pixel values), 0 keeps flat patches", default = 0)
+    parser.add_argument('--workers', type = int, help = "Number of extraction processes, defaults to the number of cores", default = None)
+    parser.add_argument('--manifest', type = str, help = "Csv record of the extracted patches used to resume, defaults to patches_manifest.csv next to the clean output", default = None)
+    parser.add_argument('--patchstore', type = str, help = "Write patch pairs to this patch store instead of image files", default = None)
+    parser.add_argument('--lmdb', type = str, help = "Write patch pairs to this lmdb database instead of image files", default = None)
 
     args = parser.parse_args()
 
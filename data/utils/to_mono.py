@@ -40,7 +40,7 @@ def to_monochrome(tri):
         R G R G R
   """
   # monochromatic
-  mo = np.zeros((tri.shape[0], tri.shape[1])).astype("uint8")
+  mo = np.zeros((tri.shape[0], tri.shape[1]), dtype = tri.dtype)
 
   # sqeeze
   mo[0::2,0::2] = tri[0::2, 0::2, 0]    #R
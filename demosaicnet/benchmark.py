@@ -0,0 +1,267 @@
+# MIT License
+#
+# Deep Joint Demosaicking and Denoising
+# Siggraph Asia 2016
+# Michael Gharbi, Gaurav Chaurasia, Sylvain Paris, Fredo Durand
+#
+# Copyright (c) 2016 Michael Gharbi
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Micro-benchmarks for the addtional Python layers.
+
+Each benchmark times a layer against the implementation it replaced. Run
+with `python -m demosaicnet.benchmark [name ...]` from the repository root.
+"""
+
+import os
+import sys
+import tempfile
+import timeit
+
+import caffe
+import numpy as np
+
+from demosaicnet import layers
+
+REPEAT = 5
+
+
+def python_net(bsize, c, h, w, layer, param_str=None):
+    if param_str is None:
+        param = ''
+    else:
+        param = "param_str: '%s'" % param_str
+    with tempfile.NamedTemporaryFile(mode='w+', delete=False) as f:
+        f.write("""name: 'pythonnet' force_backward: true
+        input: 'data' input_shape { dim:%d dim: %d dim: %d dim: %d }
+        layer { type: 'Python' name: 'output' bottom: 'data' top: 'output'
+          python_param { module: 'demosaicnet.layers' layer: '%s' %s } }""" % (
+              bsize, c, h, w, layer, param))
+        fname = f.name
+    net = caffe.Net(fname, caffe.TRAIN)
+    os.remove(fname)
+    net.blobs['data'].data[...] = np.random.rand(bsize, c, h, w)
+    return net
+
+
+def time_ms(f, number=10):
+    """Best time of a call, in ms."""
+    return min(timeit.repeat(f, number=number, repeat=REPEAT))*1000.0/number
+
+
+def report(name, shape, old, new):
+    print '{:<24} {:<18} old {:8.2f} ms   new {:8.2f} ms   x{:.1f}'.format(
+            name, 'x'.join(str(s) for s in shape), old, new, old/new)
+
+
+def _legacy_xtrans_mosaick(bottom, top):
+    g_mask = np.zeros((6,6))
+    for y, x in [(0,0), (0,2), (0,3), (0,5), (1,1), (1,4), (2,0), (2,2),
+                 (2,3), (2,5), (3,0), (3,2), (3,3), (3,5), (4,1), (4,4),
+                 (5,0), (5,2), (5,3), (5,5)]:
+        g_mask[y, x] = 1
+    r_mask = np.zeros((6,6))
+    for y, x in [(0,4), (1,0), (1,2), (2,4), (3,1), (4,3), (4,5), (5,1)]:
+        r_mask[y, x] = 1
+    b_mask = np.zeros((6,6))
+    for y, x in [(0,1), (1,3), (1,5), (2,1), (3,4), (4,0), (4,2), (5,4)]:
+        b_mask[y, x] = 1
+
+    mask = np.dstack((r_mask,g_mask,b_mask))
+    mask = mask.transpose([2, 0, 1])
+    sz = list(bottom.shape)
+    mask = mask[None, :, :, :]
+    nh = int(np.ceil(sz[2]*1.0/6))
+    nw = int(np.ceil(sz[3]*1.0/6))
+    mask = np.tile(mask,(sz[0], 1, nh, nw))
+    mask = mask[:, :, :sz[2],:sz[3]]
+    top[...] = bottom[...]*mask
+
+
+def bench_xtrans_mosaick():
+    for shape in [(1, 3, 512, 512), (64, 3, 128, 128)]:
+        net = python_net(*(shape + ('XTransMosaickLayer',)))
+        bottom = net.blobs['data'].data
+        top = np.empty_like(bottom)
+        old = time_ms(lambda: _legacy_xtrans_mosaick(bottom, top))
+        new = time_ms(net.forward)
+        report('XTransMosaickLayer', shape, old, new)
+
+
+def _legacy_random_rot_flip(bottom, tmp, top):
+    sz = bottom.shape
+    rot = np.random.randint(0, 4, sz[0])
+    for n in range(sz[0]):
+        if rot[n] == 0:
+            tmp[n, :, :, :] = bottom[n, :, :, :]
+        else:
+            for c in range(sz[1]):
+                tmp[n, c, :, :] = np.rot90(bottom[n, c, :, :], rot[n])
+    flips = np.random.randint(0, 2, sz[0])
+    for n in range(sz[0]):
+        if flips[n] == 1:
+            for c in range(sz[1]):
+                top[n, c, :, :] = np.fliplr(tmp[n, c, :, :])
+        else:
+            top[n, :, :, :] = tmp[n, :, :, :]
+
+
+def bench_dihedral():
+    shape = (64, 3, 128, 128)
+    net = python_net(*(shape + ('RandomDihedralLayer',)))
+    bottom = net.blobs['data'].data
+    tmp = np.empty_like(bottom)
+    top = np.empty_like(bottom)
+    old = time_ms(lambda: _legacy_random_rot_flip(bottom, tmp, top))
+    new = time_ms(net.forward)
+    report('RandomDihedralLayer', shape, old, new)
+
+
+def _legacy_random_offset(bottom, top, max_offset_x, max_offset_y):
+    sz = bottom.shape
+    for n in range(sz[0]):
+        offset_y = np.random.randint(0, max_offset_y)
+        offset_x = np.random.randint(0, max_offset_x)
+
+        if offset_y > 0:
+            if offset_x > 0:
+                top[n, :, offset_y:, offset_x:] = bottom[n, :, :-offset_y, :-offset_x]
+                for y in range(offset_y):
+                    top[n, :, y, offset_x:] = bottom[n, :, 0, :-offset_x]
+                for x in range(offset_x):
+                    top[n, :, offset_y:, x] = bottom[n, :, :-offset_y, 0]
+                    for y in range(offset_y):
+                        top[n, :, y, x] = bottom[n, :, 0, 0]
+            else:
+                top[n, :, offset_y:, :] = bottom[n, :, :-offset_y, :]
+                for y in range(offset_y):
+                    top[n, :, y, :] = bottom[n, :, 0, :]
+        else:
+            if offset_x > 0:
+                top[n, :, :, offset_x:] = bottom[n, :, :, :-offset_x]
+                for x in range(offset_x):
+                    top[n, :, :, x] = bottom[n, :, :, 0]
+            else:
+                top[n, :, :, :] = bottom[n, :, :, :]
+
+
+def bench_random_offset():
+    shape = (64, 3, 128, 128)
+    for offset in [2, 6]:  # Bayer and X-Trans periods
+        param_str = '{"offset_x": %d, "offset_y": %d}' % (offset, offset)
+        net = python_net(*(shape + ('RandomOffsetLayer', param_str)))
+        bottom = net.blobs['data'].data
+        top = np.empty_like(bottom)
+        old = time_ms(lambda: _legacy_random_offset(bottom, top, offset, offset))
+        new = time_ms(net.forward)
+        report('RandomOffsetLayer({})'.format(offset), shape, old, new)
+
+
+def _legacy_pack_bayer(bottom, top):
+    top[:, 0, :, :] = bottom[:, 1, ::2, ::2]  # G
+    top[:, 1, :, :] = bottom[:, 0, ::2, 1::2]  # R
+    top[:, 2, :, :] = bottom[:, 2, 1::2, ::2]  # B
+    top[:, 3, :, :] = bottom[:, 1, 1::2, 1::2]  # G
+
+
+def _legacy_unpack_bayer(bottom, top):
+    for c in range(3):
+        top[:, c, ::2, ::2] = bottom[:, 4*c, :, :]
+        top[:, c, ::2, 1::2] = bottom[:, 4*c+1, :, :]
+        top[:, c, 1::2, ::2] = bottom[:, 4*c+2, :, :]
+        top[:, c, 1::2, 1::2] = bottom[:, 4*c+3, :, :]
+
+
+def bench_pack_unpack():
+    for bsize in [1, 64]:
+        shape = (bsize, 3, 512, 512)
+        net = python_net(*(shape + ('PackBayerMosaickLayer',)))
+        bottom = net.blobs['data'].data
+        top = np.empty_like(net.blobs['output'].data)
+        old = time_ms(lambda: _legacy_pack_bayer(bottom, top))
+        new = time_ms(net.forward)
+        report('PackBayerMosaickLayer', shape, old, new)
+        del net
+
+        shape = (bsize, 12, 256, 256)
+        net = python_net(*(shape + ('UnpackBayerMosaickLayer',)))
+        bottom = net.blobs['data'].data
+        top = np.empty_like(net.blobs['output'].data)
+        old = time_ms(lambda: _legacy_unpack_bayer(bottom, top))
+        new = time_ms(net.forward)
+        report('UnpackBayerMosaickLayer', shape, old, new)
+        del net
+
+
+def _strided_space_to_depth(full, packed):
+    for dy in range(2):
+        for dx in range(2):
+            packed[:, 2*dy+dx::4] = full[:, :, dy::2, dx::2]
+
+
+def _reshaped_depth_to_space(full, packed):
+    n, c, h, w = full.shape
+    full.reshape(n, c, h//2, 2, w//2, 2)[...] = packed.reshape(
+            n, c, 2, 2, h//2, w//2).transpose(0, 1, 4, 2, 5, 3)
+
+
+# Packed channel of each BAYER_QUAD sample in the space-to-depth layout
+_QUAD_CHANNELS = [4*c + 2*dy + dx for c, dy, dx in layers.BAYER_QUAD]
+
+
+def _reshaped_pack_bayer(full, packed, tmp):
+    layers._space_to_depth(full, tmp)
+    np.take(tmp, _QUAD_CHANNELS, axis=1, out=packed)
+
+
+def bench_space_to_depth():
+    """Strided copies (old) against a single reshape/transpose (new).
+
+    Only space_to_depth uses the reshape: it is slower for the other two.
+    """
+    for shape in [(1, 3, 512, 512), (64, 3, 128, 128)]:
+        n, c, h, w = shape
+        full = np.random.rand(*shape).astype(np.float32)
+        packed = np.empty((n, 4*c, h//2, w//2), np.float32)
+        old = time_ms(lambda: _strided_space_to_depth(full, packed))
+        new = time_ms(lambda: layers._space_to_depth(full, packed))
+        report('space_to_depth', shape, old, new)
+        old = time_ms(lambda: layers._space_to_depth(full, packed, inverse=True))
+        new = time_ms(lambda: _reshaped_depth_to_space(full, packed))
+        report('depth_to_space', shape, old, new)
+        tmp = packed
+        packed = np.empty((n, 4, h//2, w//2), np.float32)
+        old = time_ms(lambda: layers._pack_bayer(full, packed))
+        new = time_ms(lambda: _reshaped_pack_bayer(full, packed, tmp))
+        report('pack_bayer', shape, old, new)
+
+
+BENCHMARKS = {
+    'xtrans_mosaick': bench_xtrans_mosaick,
+    'dihedral': bench_dihedral,
+    'random_offset': bench_random_offset,
+    'pack_unpack': bench_pack_unpack,
+    'space_to_depth': bench_space_to_depth,
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(BENCHMARKS.keys())
+    for name in names:
+        BENCHMARKS[name]()
@@ -0,0 +1,659 @@
+# MIT License
+#
+# Deep Joint Demosaicking and Denoising
+# Siggraph Asia 2016
+# Michael Gharbi, Gaurav Chaurasia, Sylvain Paris, Fredo Durand
+#
+# Copyright (c) 2016 Michael Gharbi
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Caffe-free inference for the deploy networks.
+
+Net reads a deploy.prototxt and its weights.caffemodel without protobuf or
+Caffe, and runs the forward pass with NumPy. It mimics the part of caffe.Net
+bin/demosaick uses: blobs[name].reshape, blobs[name].data and forward().
+
+Convolutions are computed as one GEMM per image on an im2col buffer. Blobs
+and the im2col workspace only grow, so after the first forward pass for a
+given tile size no activation memory is allocated.
+"""
+
+import collections
+import re
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+# Field numbers of the caffe.proto messages we read from a caffemodel
+NET_LAYER = 100
+NET_V1_LAYERS = 2
+LAYER_NAME = 1
+LAYER_BLOBS = 7
+V1_LAYER_NAME = 4
+V1_LAYER_BLOBS = 6
+BLOB_NUM, BLOB_CHANNELS, BLOB_HEIGHT, BLOB_WIDTH = 1, 2, 3, 4
+BLOB_DATA = 5
+BLOB_SHAPE = 7
+BLOB_DOUBLE_DATA = 8
+SHAPE_DIM = 1
+
+_TOKEN = re.compile(r"""\s*(?:\#[^\n]*|("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')|([{}:\[\],;])|([^\s{}:\[\],;\#"']+))""")
+
+
+def parse_prototxt(text):
+    """Parses a protobuf text message into nested dicts.
+
+    Every field maps to the list of its values, in order. Strings are
+    unquoted, numbers converted and enums kept as their name.
+    """
+    tokens = []
+    pos = 0
+    text = text.strip()
+    while pos < len(text):
+        m = _TOKEN.match(text, pos)
+        if m is None or m.end() == pos:
+            raise ValueError('Could not parse prototxt at "{}".'.format(text[pos:pos+20]))
+        pos = m.end()
+        if m.group(1) is not None:
+            tokens.append(('string', m.group(1)[1:-1]))
+        elif m.group(2) is not None:
+            tokens.append(('symbol', m.group(2)))
+        elif m.group(3) is not None:
+            tokens.append(('word', m.group(3)))
+
+    message, pos = _parse_message(tokens, 0)
+    if pos != len(tokens):
+        raise ValueError('Unbalanced braces in prototxt.')
+    return message
+
+
+def _parse_message(tokens, pos):
+    message = collections.OrderedDict()
+    while pos < len(tokens) and tokens[pos] != ('symbol', '}'):
+        kind, name = tokens[pos]
+        if kind != 'word':
+            raise ValueError('Expected a field name, got "{}".'.format(name))
+        pos += 1
+        if tokens[pos] == ('symbol', ':'):
+            pos += 1
+        if tokens[pos] == ('symbol', '{'):
+            value, pos = _parse_message(tokens, pos+1)
+            if pos == len(tokens):
+                raise ValueError('Unbalanced braces in prototxt.')
+            pos += 1
+        else:
+            value = _parse_scalar(tokens[pos])
+            pos += 1
+        if pos < len(tokens) and tokens[pos] in [('symbol', ','), ('symbol', ';')]:
+            pos += 1
+        message.setdefault(name, []).append(value)
+    return message, pos
+
+
+def _parse_scalar(token):
+    kind, value = token
+    if kind == 'string':
+        return value
+    if value in ['true', 'false']:
+        return value == 'true'
+    for cast in [int, float]:
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
+
+
+def _read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _fields(buf, start, end):
+    """Iterates over the (field, wire type, value) of a serialized message.
+
+    Varints are decoded, other values are returned as their (start, end)
+    byte range.
+    """
+    pos = start
+    while pos < end:
+        key, pos = _read_varint(buf, pos)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = _read_varint(buf, pos)
+        elif wire_type == 1:
+            value = (pos, pos+8)
+            pos += 8
+        elif wire_type == 2:
+            size, pos = _read_varint(buf, pos)
+            value = (pos, pos+size)
+            pos += size
+        elif wire_type == 5:
+            value = (pos, pos+4)
+            pos += 4
+        else:
+            raise ValueError('Unsupported wire type {} in caffemodel.'.format(wire_type))
+        yield field, wire_type, value
+
+
+def _read_blob(buf, start, end):
+    legacy = [1, 1, 1, 1]
+    shape = None
+    chunks = []
+    for field, wire_type, value in _fields(buf, start, end):
+        if field in [BLOB_DATA, BLOB_DOUBLE_DATA]:
+            dtype = '<f4' if field == BLOB_DATA else '<f8'
+            chunks.append(np.frombuffer(buf[value[0]:value[1]], dtype=dtype))
+        elif field == BLOB_SHAPE:
+            shape = []
+            for dim_field, dim_type, dim in _fields(buf, *value):
+                if dim_field != SHAPE_DIM:
+                    continue
+                if dim_type == 2:  # packed
+                    pos = dim[0]
+                    while pos < dim[1]:
+                        d, pos = _read_varint(buf, pos)
+                        shape.append(d)
+                else:
+                    shape.append(dim)
+        elif field in [BLOB_NUM, BLOB_CHANNELS, BLOB_HEIGHT, BLOB_WIDTH]:
+            legacy[field-1] = value
+
+    if shape is None:
+        shape = legacy
+    data = np.concatenate(chunks) if chunks else np.zeros(0)
+    return data.astype(np.float32).reshape(shape)
+
+
+def parse_caffemodel(data):
+    """Returns the weights of a serialized NetParameter as {layer name: [arrays]}."""
+    buf = bytearray(data)
+    weights = collections.OrderedDict()
+    for field, _, value in _fields(buf, 0, len(buf)):
+        if field == NET_LAYER:
+            name_field, blobs_field = LAYER_NAME, LAYER_BLOBS
+        elif field == NET_V1_LAYERS:
+            name_field, blobs_field = V1_LAYER_NAME, V1_LAYER_BLOBS
+        else:
+            continue
+        name = None
+        blobs = []
+        for layer_field, _, layer_value in _fields(buf, *value):
+            if layer_field == name_field:
+                name = str(buf[layer_value[0]:layer_value[1]].decode('utf-8'))
+            elif layer_field == blobs_field:
+                blobs.append(_read_blob(buf, *layer_value))
+        if blobs:
+            weights[name] = blobs
+    return weights
+
+
+class Blob(object):
+    """An activation, exposed like a caffe blob through data and reshape.
+
+    Memory is only allocated when data is first accessed, so declaring the
+    prototxt's input shape costs nothing: reshapes only read shapes, and
+    slices of a blob are taken from its data when they are accessed. The
+    underlying buffer only grows, reshaping to a smaller size reuses it.
+    """
+
+    def __init__(self, shape=None):
+        self._buffer = np.zeros(0, dtype=np.float32)
+        self._data = self._buffer
+        self._shape = (0,)
+        self._view = None
+        if shape is not None:
+            self.reshape(*shape)
+
+    def reshape(self, *shape):
+        self._shape = tuple(int(s) for s in shape)
+        self._view = None
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def data(self):
+        if self._view is not None:
+            blob, index = self._view
+            return blob.data[index]
+        if self._data.shape != self._shape:
+            size = int(np.prod(self._shape))
+            if size > self._buffer.size:
+                self._buffer = np.zeros(size, dtype=np.float32)
+            self._data = self._buffer[:size].reshape(self._shape)
+        return self._data
+
+    def share(self, blob, index):
+        """Makes this blob the view blob.data[index], e.g. a slice of another blob.
+
+        index is a tuple of slices, the view is only taken when data is accessed.
+        """
+        self._view = (blob, index)
+        self._shape = tuple(len(range(*i.indices(n))) for i, n in zip(index, blob.shape))
+
+
+class _Workspace(object):
+    """Scratch buffer shared by the layers of a net, e.g. for im2col."""
+
+    def __init__(self):
+        self._buffer = np.zeros(0, dtype=np.float32)
+
+    def get(self, shape):
+        size = int(np.prod(shape))
+        if size > self._buffer.size:
+            self._buffer = np.zeros(size, dtype=np.float32)
+        return self._buffer[:size].reshape(shape)
+
+
+def _first(param, name, default=None):
+    values = param.get(name)
+    if not values:
+        return default
+    return values[0]
+
+
+def _pair(param, name, default):
+    """Reads a spatial parameter given as name, name_h/name_w or repeated name."""
+    h = _first(param, name + '_h')
+    w = _first(param, name + '_w')
+    if h is not None or w is not None:
+        return h, w
+    values = param.get(name, [])
+    if not values:
+        return default, default
+    if len(values) == 1:
+        return values[0], values[0]
+    return values[0], values[1]
+
+
+class _Layer(object):
+    def __init__(self, param, blobs, workspace):
+        self.name = _first(param, 'name')
+        self.bottom = param.get('bottom', [])
+        self.top = param.get('top', [])
+
+    def reshape(self, bottom, top):
+        pass
+
+    def forward(self, bottom, top):
+        pass
+
+
+class _InputLayer(_Layer):
+    def __init__(self, param, blobs, workspace):
+        super(_InputLayer, self).__init__(param, blobs, workspace)
+        p = _first(param, 'input_param', {})
+        self.shapes = [s.get('dim', []) for s in p.get('shape', [])]
+
+    def setup(self, top):
+        for i, t in enumerate(top):
+            t.reshape(*self.shapes[min(i, len(self.shapes)-1)])
+
+
+class _ConvolutionLayer(_Layer):
+    def __init__(self, param, blobs, workspace):
+        super(_ConvolutionLayer, self).__init__(param, blobs, workspace)
+        p = _first(param, 'convolution_param', {})
+        self.num_output = _first(p, 'num_output')
+        self.group = _first(p, 'group', 1)
+        self.kernel = _pair(p, 'kernel', 1)
+        if 'kernel_size' in p:
+            self.kernel = _pair(p, 'kernel_size', 1)
+        self.stride = _pair(p, 'stride', 1)
+        self.pad = _pair(p, 'pad', 0)
+        self.dilation = _pair(p, 'dilation', 1)
+        self.workspace = workspace
+        self.padded = Blob()
+
+        if not blobs:
+            raise ValueError('No weights for layer "{}".'.format(self.name))
+        self.weights = blobs[0]
+        if _first(p, 'bias_term', True) and len(blobs) > 1:
+            self.bias = blobs[1].reshape(-1, 1)
+        else:
+            self.bias = None
+
+    def _extent(self, i):
+        return self.dilation[i]*(self.kernel[i]-1) + 1
+
+    def reshape(self, bottom, top):
+        n, c, h, w = bottom[0].shape
+        ho = (h + 2*self.pad[0] - self._extent(0)) // self.stride[0] + 1
+        wo = (w + 2*self.pad[1] - self._extent(1)) // self.stride[1] + 1
+        top[0].reshape(n, self.num_output, ho, wo)
+
+    def _im2col(self, x, ho, wo):
+        c, h, w = x.shape
+        kh, kw = self.kernel
+        if (kh, kw) == (1, 1) and self.stride == (1, 1):
+            return x.reshape(c, h*w)
+        sc, sh, sw = x.strides
+        dh, dw = self.dilation
+        patches = as_strided(x, shape=(c, kh, kw, ho, wo),
+                             strides=(sc, sh*dh, sw*dw, sh*self.stride[0], sw*self.stride[1]))
+        cols = self.workspace.get((c, kh, kw, ho, wo))
+        cols[...] = patches
+        return cols.reshape(c*kh*kw, ho*wo)
+
+    def forward(self, bottom, top):
+        x = bottom[0].data
+        y = top[0].data
+        n, c, h, w = x.shape
+        _, o, ho, wo = y.shape
+        ph, pw = self.pad
+        g = self.group
+        weights = self.weights.reshape(g, o // g, -1)
+
+        if ph > 0 or pw > 0:
+            self.padded.reshape(n, c, h+2*ph, w+2*pw)
+            padded = self.padded.data
+            padded[...] = 0
+            padded[:, :, ph:ph+h, pw:pw+w] = x
+            x = padded
+
+        for i in range(n):
+            yi = y[i].reshape(g, o // g, ho*wo)
+            for j in range(g):
+                cols = self._im2col(x[i, j*(c // g):(j+1)*(c // g)], ho, wo)
+                np.dot(weights[j], cols, out=yi[j])
+            if self.bias is not None:
+                yi = yi.reshape(o, ho*wo)
+                yi += self.bias
+
+
+class _DeconvolutionLayer(_ConvolutionLayer):
+    def reshape(self, bottom, top):
+        n, c, h, w = bottom[0].shape
+        ho = self.stride[0]*(h-1) + self._extent(0) - 2*self.pad[0]
+        wo = self.stride[1]*(w-1) + self._extent(1) - 2*self.pad[1]
+        top[0].reshape(n, self.num_output, ho, wo)
+
+    def forward(self, bottom, top):
+        x = bottom[0].data
+        y = top[0].data
+        n, c, h, w = x.shape
+        _, o, ho, wo = y.shape
+        g = self.group
+        kh, kw = self.kernel
+        sh, sw = self.stride
+        dh, dw = self.dilation
+        ph, pw = self.pad
+        # Caffe stores deconvolution weights as (input, output/group, kh, kw)
+        weights = self.weights.reshape(g, c // g, -1)
+
+        full = self.workspace.get((o, ho+2*ph, wo+2*pw))
+        for i in range(n):
+            full[...] = 0
+            for j in range(g):
+                xj = x[i, j*(c // g):(j+1)*(c // g)].reshape(c // g, h*w)
+                cols = np.dot(weights[j].T, xj).reshape(o // g, kh, kw, h, w)
+                out = full[j*(o // g):(j+1)*(o // g)]
+                for ky in range(kh):
+                    for kx in range(kw):
+                        out[:, ky*dh:ky*dh+sh*(h-1)+1:sh,
+                            kx*dw:kx*dw+sw*(w-1)+1:sw] += cols[:, ky, kx]
+            y[i] = full[:, ph:ph+ho, pw:pw+wo]
+            if self.bias is not None:
+                y[i] += self.bias.reshape(o, 1, 1)
+
+
+class _ReLULayer(_Layer):
+    def __init__(self, param, blobs, workspace):
+        super(_ReLULayer, self).__init__(param, blobs, workspace)
+        p = _first(param, 'relu_param', {})
+        self.negative_slope = _first(p, 'negative_slope', 0)
+
+    def reshape(self, bottom, top):
+        if top[0] is not bottom[0]:
+            top[0].reshape(*bottom[0].shape)
+
+    def forward(self, bottom, top):
+        x = bottom[0].data
+        if self.negative_slope:
+            top[0].data[...] = np.where(x > 0, x, self.negative_slope*x)
+        else:
+            np.maximum(x, 0, out=top[0].data)
+
+
+class _SliceLayer(_Layer):
+    """Slices are views of the bottom blob, nothing is copied."""
+
+    def __init__(self, param, blobs, workspace):
+        super(_SliceLayer, self).__init__(param, blobs, workspace)
+        p = _first(param, 'slice_param', {})
+        self.axis = _first(p, 'axis', _first(p, 'slice_dim', 1))
+        self.slice_points = p.get('slice_point', [])
+
+    def reshape(self, bottom, top):
+        shape = bottom[0].shape
+        size = shape[self.axis]
+        if self.slice_points:
+            bounds = [0] + list(self.slice_points) + [size]
+        else:
+            step = size // len(top)
+            bounds = [i*step for i in range(len(top)+1)]
+        index = [slice(None)]*len(shape)
+        for t, start, end in zip(top, bounds[:-1], bounds[1:]):
+            index[self.axis] = slice(start, end)
+            t.share(bottom[0], tuple(index))
+
+
+class _ConcatLayer(_Layer):
+    def __init__(self, param, blobs, workspace):
+        super(_ConcatLayer, self).__init__(param, blobs, workspace)
+        p = _first(param, 'concat_param', {})
+        self.axis = _first(p, 'axis', _first(p, 'concat_dim', 1))
+
+    def reshape(self, bottom, top):
+        shape = list(bottom[0].shape)
+        shape[self.axis] = sum(b.shape[self.axis] for b in bottom)
+        top[0].reshape(*shape)
+
+    def forward(self, bottom, top):
+        y = top[0].data
+        index = [slice(None)]*y.ndim
+        start = 0
+        for b in bottom:
+            end = start + b.shape[self.axis]
+            index[self.axis] = slice(start, end)
+            y[tuple(index)] = b.data
+            start = end
+
+
+class _EltwiseLayer(_Layer):
+    def __init__(self, param, blobs, workspace):
+        super(_EltwiseLayer, self).__init__(param, blobs, workspace)
+        p = _first(param, 'eltwise_param', {})
+        self.operation = _first(p, 'operation', 'SUM')
+        self.coeff = p.get('coeff', [])
+        if self.operation not in ['PROD', 'SUM', 'MAX']:
+            raise ValueError('Unknown eltwise operation "{}".'.format(self.operation))
+
+    def reshape(self, bottom, top):
+        top[0].reshape(*bottom[0].shape)
+
+    def forward(self, bottom, top):
+        y = top[0].data
+        if self.operation == 'PROD':
+            np.multiply(bottom[0].data, bottom[1].data, out=y)
+            for b in bottom[2:]:
+                y *= b.data
+        elif self.operation == 'MAX':
+            np.maximum(bottom[0].data, bottom[1].data, out=y)
+            for b in bottom[2:]:
+                np.maximum(y, b.data, out=y)
+        else:
+            coeff = self.coeff or [1]*len(bottom)
+            np.multiply(bottom[0].data, coeff[0], out=y)
+            for b, k in zip(bottom[1:], coeff[1:]):
+                y += k*b.data
+
+
+class _CropLikeLayer(_Layer):
+    """NumPy counterpart of demosaicnet.layers.CropLikeLayer."""
+
+    def reshape(self, bottom, top):
+        n, _, h, w = bottom[1].shape
+        c = bottom[0].shape[1]
+        top[0].reshape(n, c, h, w)
+        self.offset = [(s-d) // 2 for d, s in zip(bottom[1].shape, bottom[0].shape)]
+
+    def forward(self, bottom, top):
+        _, _, h, w = bottom[1].shape
+        oy, ox = self.offset[2], self.offset[3]
+        top[0].data[...] = bottom[0].data[:, :, oy:oy+h, ox:ox+w]
+
+
+class _ReplicateLikeLayer(_Layer):
+    """NumPy counterpart of demosaicnet.layers.ReplicateLikeLayer."""
+
+    def reshape(self, bottom, top):
+        shape = list(bottom[1].shape)
+        shape[1] = 1
+        top[0].reshape(*shape)
+        if bottom[0].shape[0] != bottom[1].shape[0]:
+            raise ValueError('Inputs batch size do not match.')
+
+    def forward(self, bottom, top):
+        top[0].data[...] = bottom[0].data.reshape(-1, 1, 1, 1)
+
+
+LAYERS = {
+    'Input': _InputLayer,
+    'Convolution': _ConvolutionLayer,
+    'Deconvolution': _DeconvolutionLayer,
+    'ReLU': _ReLULayer,
+    'Slice': _SliceLayer,
+    'Concat': _ConcatLayer,
+    'Eltwise': _EltwiseLayer,
+}
+
+PYTHON_LAYERS = {
+    'CropLikeLayer': _CropLikeLayer,
+    'ReplicateLikeLayer': _ReplicateLikeLayer,
+}
+
+
+def _make_layer(param, weights, workspace):
+    kind = _first(param, 'type')
+    name = _first(param, 'name')
+    if kind == 'Python':
+        kind = _first(_first(param, 'python_param', {}), 'layer')
+        layers = PYTHON_LAYERS
+    else:
+        layers = LAYERS
+    if kind not in layers:
+        raise ValueError('Layer "{}" has unsupported type {}.'.format(name, kind))
+    return layers[kind](param, weights.get(name, []), workspace)
+
+
+class Net(object):
+    """A deploy network loaded from prototxt and caffemodel files.
+
+    Only the layers used by the pretrained models are supported. Layers run
+    in prototxt order, outputs are in blobs like with caffe.Net.
+    """
+
+    def __init__(self, arch_path, weights_path):
+        with open(arch_path) as fid:
+            arch = parse_prototxt(fid.read())
+        with open(weights_path, 'rb') as fid:
+            weights = parse_caffemodel(fid.read())
+        self._build(arch, weights)
+
+    @classmethod
+    def from_graph(cls, arch, weights):
+        """Builds a net from a parsed prototxt and its {layer name: [arrays]} weights."""
+        net = cls.__new__(cls)
+        net._build(arch, weights)
+        return net
+
+    def _build(self, arch, weights):
+        workspace = _Workspace()
+        self.blobs = collections.OrderedDict()
+        self.layers = []
+
+        # Legacy net-level input declarations
+        inputs = arch.get('input', [])
+        shapes = [s.get('dim', []) for s in arch.get('input_shape', [])]
+        dims = arch.get('input_dim', [])
+        for i, name in enumerate(inputs):
+            if shapes:
+                self.blobs[name] = Blob(shapes[min(i, len(shapes)-1)])
+            else:
+                self.blobs[name] = Blob(dims[4*i:4*i+4])
+
+        for param in arch.get('layer', []) + arch.get('layers', []):
+            if any(r.get('phase') == ['TRAIN'] for r in param.get('include', [])):
+                continue
+            layer = _make_layer(param, weights, workspace)
+            for name in layer.top:
+                if name not in self.blobs:
+                    self.blobs[name] = Blob()
+            if isinstance(layer, _InputLayer):
+                layer.setup([self.blobs[t] for t in layer.top])
+            else:
+                for name in layer.bottom:
+                    if name not in self.blobs:
+                        raise ValueError('Layer "{}" needs unknown blob "{}".'.format(
+                            layer.name, name))
+                self.layers.append(layer)
+        self.reshape()
+
+    def reshape(self):
+        for layer in self.layers:
+            layer.reshape([self.blobs[b] for b in layer.bottom],
+                          [self.blobs[t] for t in layer.top])
+
+    def forward(self):
+        """Runs all layers on the current inputs, reshaping blobs as needed."""
+        for layer in self.layers:
+            bottom = [self.blobs[b] for b in layer.bottom]
+            top = [self.blobs[t] for t in layer.top]
+            layer.reshape(bottom, top)
+            layer.forward(bottom, top)
+
+
+REFERENCE_FILE = 'reference.npz'
+REFERENCE_TOLERANCE = 1e-4
+
+
+def run_reference(net, path):
+    """Runs a net on the inputs of a reference file, returns (output, expected).
+
+    A reference file holds the 'mosaick' and, for denoising models,
+    'noise_level' inputs of a model and the 'output' Caffe computed for
+    them (see bin/write_references). Works with a Net or a caffe.Net.
+    """
+    reference = np.load(path)
+    for name in ['mosaick', 'noise_level']:
+        if name in reference.files and name in net.blobs:
+            net.blobs[name].reshape(*reference[name].shape)
+            net.blobs[name].data[...] = reference[name]
+    net.forward()
+    return net.blobs['output'].data, reference['output']
@@ -28,6 +28,64 @@
 import caffe
 import json
 import numpy as np
+import Queue
+import threading
+
+from demosaicnet.mosaick import mosaick, mosaick_mask
+from demosaicnet.patchstore import PatchStore
+
+
+# Packed channel -> (channel, row, column) of its sample in a 2x2 Bayer quad
+BAYER_QUAD = [(1, 0, 0),  # G
+              (0, 0, 1),  # R
+              (2, 1, 0),  # B
+              (1, 1, 1)]  # G
+
+
+def _pack_bayer(full, packed, unpack=False):
+    """Copies between a (N, 3, H, W) Bayer array and its (N, 4, H/2, W/2) packing.
+
+    Four strided copies beat going through _space_to_depth and gathering the
+    BAYER_QUAD channels, which also copies the 8 unused ones (see benchmark.py).
+    """
+    for k, (c, dy, dx) in enumerate(BAYER_QUAD):
+        if unpack:
+            full[:, c, dy::2, dx::2] = packed[:, k]
+        else:
+            packed[:, k] = full[:, c, dy::2, dx::2]
+
+
+def _space_to_depth(full, packed, inverse=False):
+    """Copies between (N, C, H, W) and (N, 4C, H/2, W/2), channel 4c+2dy+dx
+    holding the samples of channel c at row dy and column dx of each 2x2 quad.
+    """
+    if not inverse:
+        n, c, h, w = full.shape
+        packed.reshape(n, c, 2, 2, h//2, w//2)[...] = full.reshape(
+                n, c, h//2, 2, w//2, 2).transpose(0, 1, 3, 5, 2, 4)
+        return
+    # A single transposed copy is ~4x slower this way round, as its inner
+    # loop only runs over the 2 columns of a quad (see benchmark.py).
+    for dy in range(2):
+        for dx in range(2):
+            full[:, :, dy::2, dx::2] = packed[:, 2*dy+dx::4]
+
+
+def _dihedral(x, k):
+    """View of x with the k-th (0-7) flip/rotation applied to its last two axes."""
+    if k >= 4:
+        x = x[..., ::-1]
+    for _ in range(k % 4):
+        x = x[..., ::-1].swapaxes(-1, -2)  # rot90
+    return x
+
+
+def _offset(src, dst, oy, ox):
+    """Shifts a (..., H, W) array down/right, replicating its first row and column."""
+    h, w = src.shape[-2:]
+    dst[..., oy:, ox:] = src[..., :h-oy, :w-ox]
+    dst[..., :oy, ox:] = src[..., :1, :w-ox]
+    dst[..., :, :ox] = dst[..., :, ox:ox+1]
 
 
 class BayerMosaickLayer(caffe.Layer):
@@ -55,13 +113,7 @@ class BayerMosaickLayer(caffe.Layer):
            B G B G B
            G R G R G
         """
-        top[0].data[:, :, :, :] = 0
-        top[0].data[:, 1, ::2, ::2] = bottom[0].data[:, 1, ::2, ::2]      # G
-        top[0].data[:, 0, ::2, 1::2] = bottom[0].data[:, 0, ::2, 1::2]    # R
-        top[0].data[:, 2, 1::2, ::2] = bottom[0].data[:, 2, 1::2, ::2]    # B
-        top[0].data[:, 1, 1::2, 1::2] = bottom[0].data[:, 1, 1::2, 1::2]  # G
-
-        assert len(top[0].data.shape) == 4, "Bayer Mosaic hidden layer is 4D."
+        mosaick(bottom[0].data, 'bayer', out=top[0].data)
 
     def backward(self, top, propagate_down, bottom):
         raise Exception('gradient is invalid')
@@ -82,8 +134,14 @@ class XTransMosaickLayer(caffe.Layer):
         if sz[1] != 3:
             raise Exception("Input should have 3 channels.")
 
+        self.mask = None
+
     def reshape(self, bottom, top):
         top[0].reshape(*bottom[0].data.shape)
+        # Broadcast over the batch, only rebuilt when the blob is resized
+        sz = bottom[0].data.shape
+        if self.mask is None or self.mask.shape != sz[1:]:
+            self.mask = mosaick_mask('xtrans', sz[2], sz[3], top[0].data.dtype)
 
     def forward(self, bottom, top):
         """XTrans Mosaick.
@@ -95,70 +153,7 @@ class XTransMosaickLayer(caffe.Layer):
            b G b r G r
            G r G G b G
         """
-
-        g_mask = np.zeros((6,6))
-        g_mask[0,0] = 1
-        g_mask[0,2] = 1
-        g_mask[0,3] = 1
-        g_mask[0,5] = 1
-
-        g_mask[1,1] = 1
-        g_mask[1,4] = 1
-
-        g_mask[2,0] = 1
-        g_mask[2,2] = 1
-        g_mask[2,3] = 1
-        g_mask[2,5] = 1
-
-        g_mask[3,0] = 1
-        g_mask[3,2] = 1
-        g_mask[3,3] = 1
-        g_mask[3,5] = 1
-
-        g_mask[4,1] = 1
-        g_mask[4,4] = 1
-
-        g_mask[5,0] = 1
-        g_mask[5,2] = 1
-        g_mask[5,3] = 1
-        g_mask[5,5] = 1
-
-        r_mask = np.zeros((6,6))
-        r_mask[0,4] = 1
-        r_mask[1,0] = 1
-        r_mask[1,2] = 1
-        r_mask[2,4] = 1
-        r_mask[3,1] = 1
-        r_mask[4,3] = 1
-        r_mask[4,5] = 1
-        r_mask[5,1] = 1
-
-        b_mask = np.zeros((6,6))
-        b_mask[0,1] = 1
-        b_mask[1,3] = 1
-        b_mask[1,5] = 1
-        b_mask[2,1] = 1
-        b_mask[3,4] = 1
-        b_mask[4,0] = 1
-        b_mask[4,2] = 1
-        b_mask[5,4] = 1
-
-        mask = np.dstack((r_mask,g_mask,b_mask))
-        mask = mask.transpose([2, 0, 1])
-
-        sz = list(bottom[0].data.shape)
-
-        mask = mask[None, :, :, :]
-
-        h = sz[2]
-        w = sz[3]
-        nh = np.ceil(h*1.0/6)
-        nw = np.ceil(w*1.0/6)
-
-        mask = np.tile(mask,(sz[0], 1, nh, nw))
-        mask = mask[:, :, :h,:w]
-
-        top[0].data[...] = bottom[0].data[...]*mask
+        np.multiply(bottom[0].data, self.mask, out=top[0].data)
 
     def backward(self, top, propagate_down, bottom):
         raise Exception('gradient is invalid')
@@ -188,23 +183,21 @@ class MonoToTriBayer(caffe.Layer):
         top[0].reshape(*sz)
 
     def forward(self, bottom, top):
-        sz = list(bottom[0].data.shape)
+        """Input is a monochrome Bayer array, each sample goes to the channel of its site.
 
-        """Input is a monochrome array, sample bayer pattern from each layer"""
-        top[0].data[:, 0, ::2, ::2] = bottom[0].data[:, 0, ::2, ::2]  # G
-        top[0].data[:, 1, ::2, 1::2] = bottom[0].data[:, 0, ::2, 1::2]  # R
-        top[0].data[:, 2, 1::2, ::2] = bottom[0].data[:, 0, 1::2, ::2]  # B
-        top[0].data[:, 1, 1::2, 1::2] = bottom[0].data[:, 0, 1::2, 1::2]  # G
+           G R G R G
+           B G B G B
+           G R G R G
 
-        assert top[0].data.shape[1] == 3, "Mono to tri exception, output should be trichromatic"
+        as BayerMosaickLayer and the paired records of the prefetching data layers.
+        """
+        mosaick(bottom[0].data, 'bayer', out=top[0].data)
 
     def backward(self, top, propagate_down, bottom):
         if propagate_down[0]:
-            sz = list(bottom[0].data.shape)
-            bottom[0].diff[:, 0, ::2, ::2]   = top[0].diff[:, 0, ::2, ::2] # G
-            bottom[0].diff[:, 0, ::2, 1::2]  = top[0].diff[:, 1, ::2, 1::2]  # R
-            bottom[0].diff[:, 0, 1::2, ::2]  = top[0].diff[:, 2, 1::2, ::2]  # B
-            bottom[0].diff[:, 0, 1::2, 1::2] = top[0].diff[:, 1, 1::2, 1::2]   # G
+            sz = top[0].diff.shape
+            mask = mosaick_mask('bayer', sz[2], sz[3], top[0].diff.dtype)
+            np.sum(top[0].diff*mask, axis=1, keepdims=True, out=bottom[0].diff)
 
 
 class PackBayerMosaickLayer(caffe.Layer):
@@ -234,36 +227,12 @@ class PackBayerMosaickLayer(caffe.Layer):
         top[0].reshape(*sz)
 
     def forward(self, bottom, top):
-        sz = list(bottom[0].data.shape)
-
-        # if sz[1] == 3:
         """Input is a RGB array, sample bayer pattern from each layer"""
-        top[0].data[:, 0, :, :] = bottom[0].data[:, 1, ::2, ::2]  # G
-        top[0].data[:, 1, :, :] = bottom[0].data[:, 0, ::2, 1::2]  # R
-        top[0].data[:, 2, :, :] = bottom[0].data[:, 2, 1::2, ::2]  # B
-        top[0].data[:, 3, :, :] = bottom[0].data[:, 1, 1::2, 1::2]  # G
-        #
-        # elif sz[1] == 1:
-        #     """Input is a Monochrome bayer array, sample from corresponding location"""
-        #     top[0].data[:, 0, :, :] = bottom[0].data[:, 0, ::2, ::2]  # G
-        #     top[0].data[:, 1, :, :] = bottom[0].data[:, 0, ::2, 1::2]  # R
-        #     top[0].data[:, 2, :, :] = bottom[0].data[:, 0, 1::2, ::2]  # B
-        #     top[0].data[:, 3, :, :] = bottom[0].data[:, 0, 1::2, 1::2]  # G
+        _pack_bayer(bottom[0].data, top[0].data)
 
     def backward(self, top, propagate_down, bottom):
         if propagate_down[0]:
-            sz = list(bottom[0].data.shape)
-            # if sz[1] == 3:
-            bottom[0].diff[:, 1, ::2, ::2]   = top[0].diff[:, 0, :, :] # G
-            bottom[0].diff[:, 0, ::2, 1::2]  = top[0].diff[:, 1, :, :]  # R
-            bottom[0].diff[:, 2, 1::2, ::2]  = top[0].diff[:, 2, :, :]  # B
-            bottom[0].diff[:, 1, 1::2, 1::2] = top[0].diff[:, 3, :, :]   # G
-            # elif sz[1] == 1:
-            #     bottom[0].diff[:, 0, ::2, ::2]   = top[0].diff[:, 0, :, :] # G
-            #     bottom[0].diff[:, 0, ::2, 1::2]  = top[0].diff[:, 1, :, :]  # R
-            #     bottom[0].diff[:, 0, 1::2, ::2]  = top[0].diff[:, 2, :, :]  # B
-            #     bottom[0].diff[:, 0, 1::2, 1::2] = top[0].diff[:, 3, :, :]   # G
-
+            _pack_bayer(bottom[0].diff, top[0].diff, unpack=True)
 
 
 class UnpackBayerMosaickLayer(caffe.Layer):
@@ -289,22 +258,20 @@ class UnpackBayerMosaickLayer(caffe.Layer):
         top[0].reshape(*sz)
 
     def forward(self, bottom, top):
-        for c in range(3):
-            top[0].data[:, c, ::2, ::2] = bottom[0].data[:, 4*c, :, :]
-            top[0].data[:, c, ::2, 1::2] = bottom[0].data[:, 4*c+1, :, :]
-            top[0].data[:, c, 1::2, ::2] = bottom[0].data[:, 4*c+2, :, :]
-            top[0].data[:, c, 1::2, 1::2] = bottom[0].data[:, 4*c+3, :, :]
+        _space_to_depth(top[0].data, bottom[0].data, inverse=True)
 
     def backward(self, top, propagate_down, bottom):
         if propagate_down[0]:
-            for c in range(3):
-                bottom[0].diff[:, 4*c, :, :]   = top[0].diff[:, c, ::2, ::2]
-                bottom[0].diff[:, 4*c+1, :, :] = top[0].diff[:, c, ::2, 1::2]
-                bottom[0].diff[:, 4*c+2, :, :] = top[0].diff[:, c, 1::2, ::2]
-                bottom[0].diff[:, 4*c+3, :, :] = top[0].diff[:, c, 1::2, 1::2]
+            _space_to_depth(top[0].diff, bottom[0].diff)
 
 
 class AddGaussianNoiseLayer(caffe.Layer):
+    """Adds Gaussian noise with a standard deviation drawn per sample.
+
+    Optional parameters: 'seed' makes the noise reproducible, 'noise_bank' > 0
+    draws the unit noise of each sample from that many pre-generated noise
+    images (with a random sign) instead of sampling it at every iteration.
+    """
     def setup(self, bottom, top):
         if len(bottom) != 1:
             raise Exception("Needs one input.")
@@ -327,25 +294,39 @@ class AddGaussianNoiseLayer(caffe.Layer):
                 raise ValueError("Max noise not provided")
             if self.min_noise > self.max_noise:
                 raise ValueError("Min noise is greater than max noise")
+            self.rng = np.random.RandomState(params.get('seed'))
+            self.noise_bank = int(params.get('noise_bank', 0))
         except:
             raise ValueError("Could not parse param string.")
 
+        self.bank = None
 
     def reshape(self, bottom, top):
         top[0].reshape(*bottom[0].data.shape)
         top[1].reshape(bottom[0].data.shape[0])
 
+        sz = bottom[0].data.shape
+        if self.noise_bank > 0 and (self.bank is None or self.bank.shape[1:] != sz[1:]):
+            self.bank = self.rng.standard_normal(
+                    (self.noise_bank,) + sz[1:]).astype(np.float32)
+
     def forward(self, bottom, top):
         sz = bottom[0].data.shape
-        noise_levels = np.random.rand(sz[0])
+        noise_levels = self.rng.rand(sz[0])
         noise_levels *= self.max_noise-self.min_noise
         noise_levels += self.min_noise
 
         top[1].data[...] = noise_levels[...]
-        for n in range(sz[0]):
-            noise_level = noise_levels[n]
-            noise = noise_level*np.random.randn(1, sz[1], sz[2], sz[3])
-            top[0].data[n, :, :, :] = bottom[0].data[n, :, :, :]+noise
+
+        if self.bank is None:
+            noise = self.rng.standard_normal(sz)
+            scale = noise_levels
+        else:
+            noise = self.bank[self.rng.randint(0, self.noise_bank, sz[0])]
+            scale = noise_levels*self.rng.choice([-1.0, 1.0], sz[0])
+        np.multiply(noise, scale[:, np.newaxis, np.newaxis, np.newaxis],
+                    out=top[0].data)
+        top[0].data[...] += bottom[0].data
 
     def backward(self, top, propagate_down, bottom):
         raise Exception('gradient is invalid')
@@ -374,25 +355,23 @@ class CropLikeLayer(caffe.Layer):
         self.offset = [(s-d)/2 for d,s in zip(dst_sz, src_sz)]
 
     def forward(self, bottom, top):
-        src_sz = bottom[0].data.shape
         dst_sz = bottom[1].data.shape
-
-        for n in range(src_sz[0]):
-            for c in range(src_sz[1]):
-                top[0].data[n, c, :, :] = bottom[0].data[n, c,
-                    self.offset[2]:self.offset[2]+dst_sz[2],
-                    self.offset[3]:self.offset[3]+dst_sz[3]]
+        top[0].data[...] = bottom[0].data[:, :,
+            self.offset[2]:self.offset[2]+dst_sz[2],
+            self.offset[3]:self.offset[3]+dst_sz[3]]
 
     def backward(self, top, propagate_down, bottom):
-        src_sz = bottom[0].data.shape
         dst_sz = bottom[1].data.shape
-        bottom[0].diff[...] = 0
-        for n in range(src_sz[0]):
-            for c in range(src_sz[1]):
-                bottom[0].diff[n, c,
-                    self.offset[2]:self.offset[2]+dst_sz[2],
-                    self.offset[3]:self.offset[3]+dst_sz[3]] = top[0].diff[n, c, :, :]
+        y0, x0 = self.offset[2], self.offset[3]
+        y1, x1 = y0+dst_sz[2], x0+dst_sz[3]
 
+        # Only the border gets no gradient, the center is overwritten below
+        diff = bottom[0].diff
+        diff[:, :, :y0, :] = 0
+        diff[:, :, y1:, :] = 0
+        diff[:, :, y0:y1, :x0] = 0
+        diff[:, :, y0:y1, x1:] = 0
+        diff[:, :, y0:y1, x0:x1] = top[0].diff
 
 
 class RandomFlipLayer(caffe.Layer):
@@ -451,6 +430,35 @@ class RandomRotLayer(caffe.Layer):
         raise Exception('gradient is invalid')
 
 
+class RandomDihedralLayer(caffe.Layer):
+    """Random flip and rotation, one of the 8 symmetries of the square per sample."""
+    def setup(self, bottom, top):
+        if len(bottom) != 1:
+            raise Exception("Needs one input.")
+
+        if len(top) != 1:
+            raise Exception("Needs one output.")
+
+        if len(bottom[0].data.shape) != 4:
+            raise Exception("Needs 4D input.")
+
+        sz = bottom[0].data.shape
+        if sz[2] != sz[3]:
+            raise Exception("Needs square input.")
+
+    def reshape(self, bottom, top):
+        top[0].reshape(*bottom[0].data.shape)
+
+    def forward(self, bottom, top):
+        sz = bottom[0].data.shape
+        transforms = np.random.randint(0, 8, sz[0])
+        for n in range(sz[0]):
+            top[0].data[n] = _dihedral(bottom[0].data[n], transforms[n])
+
+    def backward(self, top, propagate_down, bottom):
+        raise Exception('gradient is invalid')
+
+
 class RandomOffsetLayer(caffe.Layer):
     def setup(self, bottom, top):
         if len(bottom) != 1:
@@ -480,31 +488,12 @@ class RandomOffsetLayer(caffe.Layer):
         top[0].reshape(*bottom[0].data.shape)
 
     def forward(self, bottom, top):
+        """Shifts each sample down/right, replicating its first row and column."""
         sz = bottom[0].data.shape
+        offsets_y = np.random.randint(0, self.offset_y, sz[0])
+        offsets_x = np.random.randint(0, self.offset_x, sz[0])
         for n in range(sz[0]):
-            offset_y = np.random.randint(0, self.offset_y)
-            offset_x = np.random.randint(0, self.offset_x)
-
-            if offset_y > 0:
-                if offset_x > 0:
-                    top[0].data[n, :, offset_y:, offset_x:] = bottom[0].data[n, :, :-offset_y, :-offset_x]
-                    for y in range(offset_y):
-                        top[0].data[n, :, y, offset_x:] = bottom[0].data[n, :, 0, :-offset_x]
-                    for x in range(offset_x):
-                        top[0].data[n, :, offset_y:, x] = bottom[0].data[n, :, :-offset_y, 0]
-                        for y in range(offset_y):
-                            top[0].data[n, :, y, x] = bottom[0].data[n, :, 0, 0]
-                else:
-                    top[0].data[n, :, offset_y:, :] = bottom[0].data[n, :, :-offset_y, :]
-                    for y in range(offset_y):
-                        top[0].data[n, :, y, :] = bottom[0].data[n, :, 0, :]
-            else:
-                if offset_x > 0:
-                    top[0].data[n, :, :, offset_x:] = bottom[0].data[n, :, :, :-offset_x]
-                    for x in range(offset_x):
-                        top[0].data[n, :, :, x] = bottom[0].data[n, :, :, 0]
-                else:
-                    top[0].data[n, :, :, :] = bottom[0].data[n, :, :, :]
+            _offset(bottom[0].data[n], top[0].data[n], offsets_y[n], offsets_x[n])
 
     def backward(self, top, propagate_down, bottom):
         raise Exception('gradient is invalid')
@@ -566,3 +555,229 @@ class NormalizedEuclideanLayer(caffe.Layer):
             bottom[0].diff[...] = self.diff/bottom[0].count
         if propagate_down[1]:
             bottom[1].diff[...] = -self.diff/bottom[0].count
+
+
+def _default_scale(dtype):
+    """Maps integer records of any depth to [0, 1), others by 1/256."""
+    if np.issubdtype(dtype, np.integer):
+        return 1.0 / (np.iinfo(dtype).max + 1)
+    return 0.00390625
+
+
+def _datum_to_array(value):
+    datum = caffe.proto.caffe_pb2.Datum()
+    datum.ParseFromString(value)
+    return caffe.io.datum_to_array(datum)
+
+
+class _PrefetchingDataLayer(caffe.Layer):
+    """Serves training batches augmented ahead of the solver.
+
+    Does the work of a data layer followed by RandomOffsetLayer,
+    RandomDihedralLayer, AddGaussianNoiseLayer and a mosaick layer. A reader
+    thread queues the records of each batch and 'threads' worker threads
+    augment them into a ring of 'prefetch' batches, forward only copies a
+    ready batch into the tops.
+
+    Records are RGB images, or with 'paired' 4-channel pairs of a noisy
+    monochrome mosaick and its RGB ground truth, which are served as they are.
+
+    Tops: mosaick, groundtruth and, when max_noise > 0, noise_level.
+    Parameters: 'source', 'batch_size', 'offset_x', 'offset_y' and optional
+    'paired' (false), 'mosaic_type' (bayer), 'min_noise' and 'max_noise'
+    (0), 'scale' (1/256 for 8 bits records, 1/65536 for 16 bits ones),
+    'prefetch' (4), 'threads' (2), 'seed'.
+    """
+    def setup(self, bottom, top):
+        if len(bottom) != 0:
+            raise Exception("Takes no input.")
+
+        try:
+            params = json.loads(self.param_str)
+            self.source = params['source']
+            self.batch_size = int(params['batch_size'])
+            self.offset_x = params['offset_x']
+            self.offset_y = params['offset_y']
+            self.paired = bool(params.get('paired', False))
+            self.mosaic_type = params.get('mosaic_type', 'bayer')
+            self.min_noise = params.get('min_noise', 0)
+            self.max_noise = params.get('max_noise', 0)
+            if self.min_noise > self.max_noise:
+                raise ValueError("Min noise is greater than max noise")
+            self.scale = params.get('scale')
+            prefetch = int(params.get('prefetch', 4))
+            threads = int(params.get('threads', 2))
+            seed = params.get('seed')
+        except:
+            raise ValueError("Could not parse param string.")
+
+        if self.max_noise > 0 and len(top) != 3:
+            raise Exception("Needs three outputs.")
+        if self.max_noise <= 0 and len(top) != 2:
+            raise Exception("Needs two outputs.")
+
+        record = self._open()
+        c, h, w = record.shape
+        if self.paired and c != 4:
+            raise Exception("Needs paired records.")
+        if not self.paired and c != 3:
+            raise Exception("Needs RGB records.")
+        if self.paired and self.max_noise > 0:
+            raise Exception("Paired records are already noisy.")
+        if not self.paired and h != w:
+            raise Exception("Needs square images.")
+        self.record_shape = (self.batch_size, c, h, w)
+        self.record_dtype = record.dtype
+        if self.scale is None:
+            self.scale = _default_scale(record.dtype)
+        self.shape = (self.batch_size, 3, h, w)
+
+        self.records = Queue.Queue(maxsize=prefetch)
+        self.free = Queue.Queue()
+        self.ready = Queue.Queue()
+        for _ in range(prefetch):
+            self.free.put({'mosaick': np.empty(self.shape, dtype=np.float32),
+                           'groundtruth': np.empty(self.shape, dtype=np.float32),
+                           'noise_level': np.empty(self.batch_size, dtype=np.float32)})
+
+        workers = [threading.Thread(target=self._read)]
+        for i in range(threads):
+            rng = np.random.RandomState(None if seed is None else seed + i)
+            workers.append(threading.Thread(target=self._augment, args=(rng,)))
+        for t in workers:
+            t.daemon = True
+            t.start()
+
+    def _open(self):
+        """Opens the source, returns its first record as a (c, h, w) array."""
+        raise NotImplementedError
+
+    def _batches(self):
+        """Yields the records of each batch, looping over the source."""
+        raise NotImplementedError
+
+    def _decode(self, values, records):
+        """Returns a batch of records as a (n, c, h, w) array, records may hold it."""
+        raise NotImplementedError
+
+    def _read(self):
+        """Queues the records of each batch, errors are passed to forward."""
+        try:
+            for values in self._batches():
+                self.records.put(values)
+        except Exception as e:
+            self.ready.put(e)
+
+    def _augment(self, rng):
+        """Turns queued records into ready batches, errors are passed to forward."""
+        try:
+            sz = self.shape
+            records = np.empty(self.record_shape, dtype=self.record_dtype)
+            offset = np.empty(sz[1:], dtype=np.float32)
+            while True:
+                values = self.records.get()
+                batch = self.free.get()
+                images = self._decode(values, records)
+
+                groundtruth = batch['groundtruth']
+                if self.paired:
+                    np.multiply(images[:, 1:], self.scale, out=groundtruth)
+                    mosaick(images[:, :1], self.mosaic_type, out=batch['mosaick'])
+                    batch['mosaick'] *= self.scale
+                    self.ready.put(batch)
+                    continue
+
+                offsets_y = rng.randint(0, self.offset_y, sz[0])
+                offsets_x = rng.randint(0, self.offset_x, sz[0])
+                transforms = rng.randint(0, 8, sz[0])
+                for n in range(sz[0]):
+                    _offset(images[n], offset, offsets_y[n], offsets_x[n])
+                    groundtruth[n] = _dihedral(offset, transforms[n])
+                groundtruth *= self.scale
+
+                if self.max_noise > 0:
+                    noise_levels = batch['noise_level']
+                    noise_levels[...] = rng.rand(sz[0])
+                    noise_levels *= self.max_noise-self.min_noise
+                    noise_levels += self.min_noise
+                    noisy = rng.standard_normal(sz)
+                    noisy *= noise_levels[:, np.newaxis, np.newaxis, np.newaxis]
+                    noisy += groundtruth
+                    mosaick(noisy, self.mosaic_type, out=batch['mosaick'])
+                else:
+                    mosaick(groundtruth, self.mosaic_type, out=batch['mosaick'])
+
+                self.ready.put(batch)
+        except Exception as e:
+            self.ready.put(e)
+
+    def reshape(self, bottom, top):
+        top[0].reshape(*self.shape)
+        top[1].reshape(*self.shape)
+        if len(top) == 3:
+            top[2].reshape(self.batch_size)
+
+    def forward(self, bottom, top):
+        batch = self.ready.get()
+        if isinstance(batch, Exception):
+            raise batch
+        top[0].data[...] = batch['mosaick']
+        top[1].data[...] = batch['groundtruth']
+        if len(top) == 3:
+            top[2].data[...] = batch['noise_level']
+        self.free.put(batch)
+
+    def backward(self, top, propagate_down, bottom):
+        pass
+
+
+class LmdbDataLayer(_PrefetchingDataLayer):
+    """Prefetching data layer reading Datums from the lmdb at 'source'."""
+    def _open(self):
+        import lmdb
+
+        self.env = lmdb.open(self.source, readonly=True, lock=False)
+        with self.env.begin() as txn:
+            cursor = txn.cursor()
+            if not cursor.first():
+                raise Exception("Empty database.")
+            return _datum_to_array(cursor.value())
+
+    def _batches(self):
+        with self.env.begin() as txn:
+            cursor = txn.cursor()
+            cursor.first()
+            while True:
+                values = []
+                while len(values) < self.batch_size:
+                    values.append(cursor.value())
+                    if not cursor.next():
+                        cursor.first()
+                yield values
+
+    def _decode(self, values, records):
+        for n, value in enumerate(values):
+            records[n] = _datum_to_array(value)
+        return records
+
+
+class PatchStoreDataLayer(_PrefetchingDataLayer):
+    """Prefetching data layer reading the patch store at 'source'.
+
+    Batches are consecutive patches, read as views of the mapped store
+    (see demosaicnet.patchstore); a last partial batch is skipped.
+    """
+    def _open(self):
+        self.store = PatchStore(self.source)
+        if len(self.store) < self.batch_size:
+            raise Exception("Needs at least one batch of patches.")
+        return self.store.patches[0]
+
+    def _batches(self):
+        patches = self.store.patches
+        while True:
+            for start in range(0, len(patches) - self.batch_size + 1, self.batch_size):
+                yield patches[start:start+self.batch_size]
+
+    def _decode(self, values, records):
+        return values
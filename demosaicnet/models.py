@@ -28,6 +28,8 @@
 from caffe import layers as L, params as P
 import caffe
 
+from demosaicnet.patchstore import is_patch_store
+
 __all__ = ['demosaic']
 
 
@@ -74,11 +76,21 @@ def _convolution(bottom, width, ksize, pad=True, bias=True):
 def demosaic(depth, width, ksize, batch_size,
              non_linearity='relu',
              mosaic_type='bayer', trainset=None,
-             groundtruth_set=None,
+             groundtruth_set=None, paired=False, prefetch=False,
              train_mode=True,
              min_noise=0, max_noise=0, pad=True,
              batch_norm=False):
-    """Network to denoise/demosaic Bayer arrays."""
+    """Network to denoise/demosaic Bayer arrays.
+
+    With paired=True, trainset is a database whose records hold a noisy
+    monochrome mosaick and its RGB ground truth (see bin/convert_to_lmdb
+    --groundtruth), split after a single read.
+
+    With prefetch=True, the training images are read and augmented by
+    background threads of a LmdbDataLayer (PatchStoreDataLayer when trainset
+    is a patch store) instead of a Data layer followed by the augmentation
+    layers. Paired records are then mosaicked as they are.
+    """
 
     if non_linearity == 'relu':
       NL = L.ReLU
@@ -101,10 +113,39 @@ def demosaic(depth, width, ksize, batch_size,
     if add_noise and min_noise > max_noise:
         raise ValueError('min noise is greater than max_noise')
 
-    if groundtruth_set is not None and add_noise:
+    if groundtruth_set is not None and paired:
+        raise ValueError('a paired set already contains the ground truth')
+
+    if (groundtruth_set is not None or paired) and add_noise:
         raise ValueError('when ground truth set is provided, input should be noisy mosaic')
 
-    if trainset is not None and groundtruth_set is None:  # Build the network with database connection
+    if groundtruth_set is not None and prefetch:
+        raise ValueError('prefetching reads a single set, use a paired set')
+
+    if trainset is not None and prefetch:
+        # Read, augment, add noise and mosaick in background threads
+        param_str = ('{"source": "%s", "batch_size": %d, "offset_x": %d, "offset_y": %d, "paired": %s, '
+                     '"mosaic_type": "%s", "min_noise": %f, "max_noise": %f}' % (
+                         trainset, batch_size, offset_x, offset_y, 'true' if paired else 'false',
+                         mosaic_type, min_noise, max_noise))
+        if is_patch_store(trainset):
+            data_layer = 'PatchStoreDataLayer'
+        else:
+            data_layer = 'LmdbDataLayer'
+        if add_noise:
+            net.mosaick, net.groundtruth, net.noise_level = L.Python(
+                    ntop=3,
+                    python_param={'module':'demosaicnet.layers',
+                                  'layer': data_layer,
+                                  'param_str': param_str})
+        else:
+            net.mosaick, net.groundtruth = L.Python(
+                    ntop=2,
+                    python_param={'module':'demosaicnet.layers',
+                                  'layer': data_layer,
+                                  'param_str': param_str})
+
+    elif trainset is not None and groundtruth_set is None and not paired:  # Build the network with database connection
         # Read from an LMDB database for train and validation sets
         net.demosaicked = L.Data(
             data_param={'source': trainset,
@@ -117,12 +158,9 @@ def demosaic(depth, width, ksize, batch_size,
                               python_param={'module':'demosaicnet.layers',
                                             'layer': 'RandomOffsetLayer',
                                             'param_str': '{"offset_x": %s, "offset_y":%s}' % (offset_x, offset_y)})
-        net.rot = L.Python(bottom='offset',
-                            python_param={'module':'demosaicnet.layers',
-                                          'layer': 'RandomRotLayer'})
-        net.groundtruth = L.Python(bottom='rot',
+        net.groundtruth = L.Python(bottom='offset',
                               python_param={'module':'demosaicnet.layers',
-                                            'layer': 'RandomFlipLayer'})
+                                            'layer': 'RandomDihedralLayer'})
 
         # Add noise
         if add_noise:
@@ -147,6 +185,26 @@ def demosaic(depth, width, ksize, batch_size,
                                                  'layer': 'XTransMosaickLayer'})
         # ---------------------------------------------------------------------
 
+    elif trainset is not None and paired: # mosaick and ground truth in the same records
+        """
+        Each record is 128x128x4: the mosaic, then the RGB ground truth
+        """
+        net.paired = L.Data(
+            data_param = {'source': trainset,
+                        'backend': P.Data.LMDB,
+                        'batch_size': batch_size},
+                        transform_param={'scale': 0.00390625}
+        )
+        net.mosaick_mono, net.groundtruth = L.Slice(net.paired, ntop=2,
+                                                    slice_param={'axis': 1, 'slice_point': [1]})
+        net.mosaick = L.Python(bottom = 'mosaick_mono',
+                                python_param = {
+                                    'module':'demosaicnet.layers',
+                                    'layer':'MonoToTriBayer'
+                                })
+
+        # ---------------------------------------------------------------------
+
     elif trainset is not None and groundtruth_set is not None: #connect to ground truth set and trainset LMDB
         """
         The input is 128x128x1 mosaic
@@ -0,0 +1,88 @@
+# MIT License
+#
+# Deep Joint Demosaicking and Denoising
+# Siggraph Asia 2016
+# Michael Gharbi, Gaurav Chaurasia, Sylvain Paris, Fredo Durand
+#
+# Copyright (c) 2016 Michael Gharbi
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""NumPy implementation of the Bayer and X-Trans mosaicking patterns."""
+
+import numpy as np
+
+# Channel (0: R, 1: G, 2: B) sampled at each site of one period of a pattern.
+PATTERNS = {
+    'bayer': np.array([[1, 0],
+                       [2, 1]]),
+    'xtrans': np.array([[1, 2, 1, 1, 0, 1],
+                        [0, 1, 0, 2, 1, 2],
+                        [1, 2, 1, 1, 0, 1],
+                        [1, 0, 1, 1, 2, 1],
+                        [2, 1, 2, 0, 1, 0],
+                        [1, 0, 1, 1, 2, 1]]),
+}
+
+MAX_CACHED_MASKS = 16
+
+_masks = {}
+
+
+def mosaick_mask(mosaic_type, h, w, dtype=np.float32):
+    """Returns the (3, h, w) sampling mask of a mosaick pattern.
+
+    Masks are cached by shape and type and must not be modified.
+    """
+    key = (mosaic_type, h, w, np.dtype(dtype))
+    mask = _masks.get(key)
+    if mask is None:
+        if mosaic_type not in PATTERNS:
+            raise ValueError('Unknown mosaick type "{}".'.format(mosaic_type))
+        pattern = PATTERNS[mosaic_type]
+        p = pattern.shape[0]
+        sites = np.tile(pattern, ((h+p-1)/p, (w+p-1)/p))[:h, :w]
+        mask = (sites[np.newaxis] == np.arange(3)[:, np.newaxis, np.newaxis])
+        mask = mask.astype(dtype)
+        mask.flags.writeable = False
+
+        if len(_masks) >= MAX_CACHED_MASKS:
+            _masks.clear()
+        _masks[key] = mask
+    return mask
+
+
+def mosaick(im, mosaic_type, out=None, offset=(0, 0)):
+    """Samples a (..., 3, h, w) image with a mosaick pattern.
+
+    Non-sampled values are set to 0. The result is written to out when given,
+    which may be im itself. offset is the (y, x) position of the top-left
+    pixel of im in the pattern, e.g. that of a tile in a larger mosaick.
+    """
+    h, w = im.shape[-2:]
+    if out is None:
+        dtype = im.dtype
+    else:
+        dtype = out.dtype
+    if offset == (0, 0):
+        mask = mosaick_mask(mosaic_type, h, w, dtype)
+    else:
+        p = PATTERNS[mosaic_type].shape[0] if mosaic_type in PATTERNS else 1
+        oy, ox = offset[0] % p, offset[1] % p
+        mask = mosaick_mask(mosaic_type, h+oy, w+ox, dtype)[:, oy:oy+h, ox:ox+w]
+    return np.multiply(im, mask, out=out)
@@ -0,0 +1,118 @@
+# MIT License
+#
+# Deep Joint Demosaicking and Denoising
+# Siggraph Asia 2016
+# Michael Gharbi, Gaurav Chaurasia, Sylvain Paris, Fredo Durand
+#
+# Copyright (c) 2016 Michael Gharbi
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Memory-mapped store of fixed-size patches.
+
+A patch store is a directory holding patches.npy, an (capacity, c, h, w)
+array, and header.json, which records how many of its leading patches have
+been written. Reading a store maps the file instead of parsing records, so
+a batch of consecutive patches is a view into the page cache.
+"""
+
+import json
+import os
+
+import numpy as np
+
+PATCHES_FILE = 'patches.npy'
+HEADER_FILE = 'header.json'
+
+
+def is_patch_store(path):
+    return os.path.exists(os.path.join(path, HEADER_FILE))
+
+
+class PatchStore(object):
+    """A patch store opened for reading ('r') or appending ('r+')."""
+
+    def __init__(self, path, mode='r'):
+        if mode not in ['r', 'r+']:
+            raise ValueError('Unknown mode "{}".'.format(mode))
+        self.path = path
+        with open(os.path.join(path, HEADER_FILE)) as fid:
+            self.header = json.load(fid)
+        self.data = np.load(os.path.join(path, PATCHES_FILE), mmap_mode=mode)
+        self.count = self.header['count']
+
+    @staticmethod
+    def create(path, capacity, shape, dtype=np.uint8, **info):
+        """Creates an empty store for capacity patches of shape (c, h, w).
+
+        The dtype and extra keyword arguments are saved in the header.
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+        np.lib.format.open_memmap(os.path.join(path, PATCHES_FILE), mode='w+',
+                                  dtype=dtype, shape=(capacity,) + tuple(shape))
+        header = dict(info, count=0, dtype=np.dtype(dtype).name)
+        _write_header(path, header)
+        return PatchStore(path, mode='r+')
+
+    @property
+    def capacity(self):
+        return self.data.shape[0]
+
+    @property
+    def shape(self):
+        return self.data.shape[1:]
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def patches(self):
+        """Read-only view of the patches written so far."""
+        patches = self.data[:self.count]
+        patches.flags.writeable = False
+        return patches
+
+    def __len__(self):
+        return self.count
+
+    def append(self, patches):
+        """Copies (n, c, h, w) patches after the last ones, returns their first index.
+
+        They are only recorded in the header by flush.
+        """
+        n = len(patches)
+        if self.count + n > self.capacity:
+            raise ValueError('Store is full ({} patches).'.format(self.capacity))
+        self.data[self.count:self.count+n] = patches
+        self.count += n
+        return self.count - n
+
+    def flush(self):
+        """Writes the patches to disk, then the header that records them."""
+        self.data.flush()
+        self.header['count'] = self.count
+        _write_header(self.path, self.header)
+
+
+def _write_header(path, header):
+    tmp = os.path.join(path, HEADER_FILE + '.tmp')
+    with open(tmp, 'w') as fid:
+        json.dump(header, fid)
+    os.rename(tmp, os.path.join(path, HEADER_FILE))
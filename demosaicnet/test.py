@@ -26,6 +26,7 @@
 """Tests for the addtional Python layers"""
 
 import os
+import shutil
 import tempfile
 import unittest
 
@@ -33,6 +34,19 @@ import caffe
 import numpy as np
 import skimage.io
 
+from demosaicnet import weightcache
+from demosaicnet.inference import Net, REFERENCE_FILE, REFERENCE_TOLERANCE, parse_caffemodel, run_reference
+from demosaicnet.mosaick import mosaick, mosaick_mask
+from demosaicnet.layers import PatchStoreDataLayer
+from demosaicnet.patchstore import PatchStore
+
+
+class UnreadableDataLayer(PatchStoreDataLayer):
+    """Fails to read its source after setup, like a corrupt store."""
+    def _batches(self):
+        raise IOError("Unreadable source.")
+        yield
+
 
 class TestPythonLayer(unittest.TestCase):
     def python_net_file(self, bsize, c, h, w, layer):
@@ -140,6 +154,50 @@ class TestXTransMosaicLayer(TestPythonLayer):
         skimage.io.imsave('output/test_xtrans.png', im)
 
 
+class TestMosaick(TestPythonLayer):
+    def assert_sites(self, mosaic_type, sites):
+        # sites: color sampled at each pixel of one period
+        h, w = len(sites), len(sites[0])
+        mask = mosaick_mask(mosaic_type, h, w)
+        for c, color in enumerate('RGB'):
+            expected = np.array([[s == color for s in row] for row in sites])
+            assert (mask[c] == expected).all()
+
+        # Larger masks repeat the period
+        assert (mosaick_mask(mosaic_type, 2*h+1, 3*w-1) == np.tile(mask, (1, 3, 3))[:, :2*h+1, :3*w-1]).all()
+
+    def test_bayer(self):
+        self.assert_sites('bayer', ['GR',
+                                    'BG'])
+
+    def test_xtrans(self):
+        self.assert_sites('xtrans', ['GBGGRG',
+                                     'RGRBGB',
+                                     'GBGGRG',
+                                     'GRGGBG',
+                                     'BGBRGR',
+                                     'GRGGBG'])
+
+    def test_mosaick(self):
+        im = np.random.rand(2, 3, 12, 14).astype(np.float32)
+        for mosaic_type in ['bayer', 'xtrans']:
+            assert (mosaick(im, mosaic_type) == im*mosaick_mask(mosaic_type, 12, 14)).all()
+
+    def test_mask_cache(self):
+        mask = mosaick_mask('xtrans', 12, 14)
+        assert mask.shape == (3, 12, 14)
+        assert mask.dtype == np.float32
+        assert (mask.sum(axis=0) == 1).all()
+        assert mosaick_mask('xtrans', 12, 14) is mask
+
+    def test_offset(self):
+        im = np.random.rand(3, 20, 22).astype(np.float32)
+        for mosaic_type in ['bayer', 'xtrans']:
+            full = mosaick(im, mosaic_type)
+            tile = mosaick(im[:, 7:17, 5:19], mosaic_type, offset=(7, 5))
+            assert (tile == full[:, 7:17, 5:19]).all()
+
+
 class TestPackBayerMosaicLayer(TestPythonLayer):
     def setUp(self):
         net_file = self.python_net_file(16, 3, 2, 2, 'PackBayerMosaickLayer')
@@ -259,6 +317,29 @@ class TestRandomRotLayer(TestPythonLayer):
             skimage.io.imsave('output/test_rot{}.png'.format(i), im)
 
 
+class TestRandomDihedralLayer(TestPythonLayer):
+    def setUp(self):
+        net_file = self.python_net_file(64, 3, 8, 8, 'RandomDihedralLayer')
+        self.net = caffe.Net(net_file, caffe.TRAIN)
+        os.remove(net_file)
+
+    def test_forward(self):
+        data = np.random.rand(64, 3, 8, 8)
+        self.net.blobs['data'].data[...] = data
+        self.net.forward()
+
+        out = self.net.blobs['output'].data
+        for n in range(64):
+            candidates = []
+            for flip in [False, True]:
+                for rot in range(4):
+                    im = data[n].transpose([1, 2, 0])
+                    if flip:
+                        im = np.fliplr(im)
+                    candidates.append(np.rot90(im, rot).transpose([2, 0, 1]))
+            assert any(np.allclose(out[n], c) for c in candidates)
+
+
 class TestRandomOffsetLayer(TestPythonLayer):
     def python_net_file(self, bsize, c, h, w, layer):
         with tempfile.NamedTemporaryFile(mode='w+', delete=False) as f:
@@ -284,6 +365,21 @@ class TestRandomOffsetLayer(TestPythonLayer):
             im = np.squeeze(out[i,:,:,:]).transpose([1,2,0])
             skimage.io.imsave('output/test_offset{}.png'.format(i), im)
 
+    def test_shift(self):
+        data = np.random.rand(16, 3, 8, 8)
+        self.net.blobs['data'].data[...] = data
+        self.net.forward()
+
+        out = self.net.blobs['output'].data
+        for n in range(16):
+            candidates = []
+            for oy in range(2):
+                for ox in range(2):
+                    rows = np.maximum(np.arange(8) - oy, 0)
+                    cols = np.maximum(np.arange(8) - ox, 0)
+                    candidates.append(data[n][:, rows][:, :, cols])
+            assert any(np.allclose(out[n], c) for c in candidates)
+
 
 class TestCropLikeLayer(TestPythonLayer):
     def python_net_file(self):
@@ -318,6 +414,8 @@ class TestCropLikeLayer(TestPythonLayer):
         for i in range(64):
             for j in range(64):
                 self.net.blobs['output'].diff[:, :, i, j] = i*j
+        # Stale gradients must not leak through the border
+        self.net.blobs['data'].diff[...] = 1
         self.net.backward()
 
         diff = self.net.blobs['data'].diff
@@ -326,6 +424,10 @@ class TestCropLikeLayer(TestPythonLayer):
             for j in range(64):
                 assert (diff[:, :, 32+i, 32+j] == i*j).all()
 
+        border = np.ones(diff.shape, dtype=bool)
+        border[:, :, 32:96, 32:96] = False
+        assert (diff[border] == 0).all()
+
 
 class TestAddGaussianNoiseLayer(TestPythonLayer):
     def python_net_file(self, bsize, c, h, w, layer):
@@ -360,6 +462,188 @@ class TestAddGaussianNoiseLayer(TestPythonLayer):
             skimage.io.imsave('output/test_add_gaussian_noise{}.png'.format(i), im)
 
 
+class TestSeededGaussianNoiseLayer(TestPythonLayer):
+    def python_net_file(self, param_str):
+        with tempfile.NamedTemporaryFile(mode='w+', delete=False) as f:
+            f.write("""name: 'pythonnet' force_backward: true
+            input: 'data' input_shape { dim:16 dim: 3 dim: 32 dim: 32 }
+            layer { type: 'Python' name: 'output' bottom: 'data' top: 'output'
+              top: 'noise_level'
+              python_param { module: 'demosaicnet.layers' layer: 'AddGaussianNoiseLayer'
+              param_str:'%s' } }""" % param_str)
+            return f.name
+
+    def noisy(self, param_str):
+        net_file = self.python_net_file(param_str)
+        net = caffe.Net(net_file, caffe.TRAIN)
+        os.remove(net_file)
+        net.blobs['data'].data[...] = 0.5
+        net.forward()
+        return net.blobs['output'].data.copy(), net.blobs['noise_level'].data.copy()
+
+    def test_seed(self):
+        out, level = self.noisy('{"min_noise":0.01, "max_noise":0.1, "seed":3}')
+        out2, level2 = self.noisy('{"min_noise":0.01, "max_noise":0.1, "seed":3}')
+        assert (out == out2).all()
+        assert (level == level2).all()
+
+        # Noise is scaled by the per-sample level
+        std = np.std(out - 0.5, axis=(1, 2, 3))
+        assert np.allclose(std, level, rtol=0.1)
+
+    def test_noise_bank(self):
+        out, level = self.noisy('{"min_noise":0.01, "max_noise":0.1, "noise_bank":4}')
+        std = np.std(out - 0.5, axis=(1, 2, 3))
+        assert np.allclose(std, level, rtol=0.1)
+
+
+class TestLmdbDataLayer(TestPythonLayer):
+    def setUp(self):
+        import lmdb
+        self.db = tempfile.mkdtemp()
+        env = lmdb.open(self.db, map_size=1 << 26)
+        with env.begin(write=True) as txn:
+            for i in range(10):
+                im = np.full((3, 32, 32), 10*i+5, dtype=np.uint8)
+                txn.put('{:010d}'.format(i), caffe.io.array_to_datum(im).SerializeToString())
+        env.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.db)
+
+    def python_net_file(self, param_str, tops):
+        with tempfile.NamedTemporaryFile(mode='w+', delete=False) as f:
+            f.write("""name: 'pythonnet'
+            layer { type: 'Python' name: 'data' %s
+              python_param { module: 'demosaicnet.layers' layer: 'LmdbDataLayer'
+              param_str:'%s' } }""" % (' '.join("top: '%s'" % t for t in tops), param_str))
+            return f.name
+
+    def test_forward(self):
+        net_file = self.python_net_file(
+                '{"source": "%s", "batch_size": 4, "offset_x": 2, "offset_y": 2}' % self.db,
+                ['mosaick', 'groundtruth'])
+        net = caffe.Net(net_file, caffe.TRAIN)
+        os.remove(net_file)
+
+        values = set()
+        for it in range(5):
+            net.forward()
+            groundtruth = net.blobs['groundtruth'].data
+            for n in range(4):
+                # Constant images are unchanged by the offset and flips
+                assert (groundtruth[n] == groundtruth[n, 0, 0, 0]).all()
+                values.add(int(round(groundtruth[n, 0, 0, 0]*256)))
+            mask = mosaick_mask('bayer', 32, 32)
+            assert (net.blobs['mosaick'].data == groundtruth*mask).all()
+        assert values == set(range(5, 100, 10))
+
+    def test_noise(self):
+        net_file = self.python_net_file(
+                '{"source": "%s", "batch_size": 16, "offset_x": 6, "offset_y": 6, '
+                '"mosaic_type": "xtrans", "min_noise": 0.01, "max_noise": 0.1}' % self.db,
+                ['mosaick', 'groundtruth', 'noise_level'])
+        net = caffe.Net(net_file, caffe.TRAIN)
+        os.remove(net_file)
+
+        net.forward()
+        mask = mosaick_mask('xtrans', 32, 32)
+        noise = net.blobs['mosaick'].data - net.blobs['groundtruth'].data*mask
+        std = np.std(noise[:, mask.astype(bool)], axis=1)
+        assert np.allclose(std, net.blobs['noise_level'].data, rtol=0.15)
+
+
+class TestPatchStore(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_append(self):
+        store = PatchStore.create(self.path, 5, (4, 8, 8), paired=True)
+        patches = np.random.randint(0, 256, (3, 4, 8, 8)).astype(np.uint8)
+        assert store.append(patches) == 0
+        assert store.append(patches[:1]) == 3
+        self.assertRaises(ValueError, store.append, patches)
+
+        # Patches are only visible once flushed
+        assert len(PatchStore(self.path)) == 0
+        store.flush()
+        store = PatchStore(self.path)
+        assert len(store) == 4
+        assert store.header['paired']
+        assert (store.patches[:3] == patches).all()
+        assert (store.patches[3] == patches[0]).all()
+
+
+class TestPatchStoreDataLayer(TestPythonLayer):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def data_net(self, patches, module='demosaicnet.layers', layer='PatchStoreDataLayer'):
+        store = PatchStore.create(self.path, len(patches), patches.shape[1:],
+                                  dtype=patches.dtype, paired=True)
+        store.append(patches)
+        store.flush()
+        with tempfile.NamedTemporaryFile(mode='w+', delete=False) as f:
+            f.write("""name: 'pythonnet'
+            layer { type: 'Python' name: 'data' top: 'mosaick' top: 'groundtruth'
+              python_param { module: '%s' layer: '%s'
+              param_str:'{"source": "%s", "batch_size": 4, "offset_x": 2, "offset_y": 2, "paired": true, "threads": 1}' } }""" % (module, layer, self.path))
+            net_file = f.name
+        net = caffe.Net(net_file, caffe.TRAIN)
+        os.remove(net_file)
+        return net
+
+    def test_paired(self):
+        patches = np.random.randint(0, 256, (8, 4, 32, 32)).astype(np.uint8)
+        net = self.data_net(patches)
+
+        # Paired patches are served in order, without augmentation
+        mask = mosaick_mask('bayer', 32, 32)
+        for start in [0, 4, 0]:
+            net.forward()
+            expected = patches[start:start+4]/256.0
+            assert np.allclose(net.blobs['groundtruth'].data, expected[:, 1:])
+            assert np.allclose(net.blobs['mosaick'].data, expected[:, :1]*mask)
+
+    def test_matches_mono_to_tri(self):
+        patches = np.random.randint(0, 256, (4, 4, 32, 32)).astype(np.uint8)
+        net = self.data_net(patches)
+        net.forward()
+
+        # The Data + Slice + MonoToTriBayer path of paired sets
+        net_file = self.python_net_file(4, 1, 32, 32, 'MonoToTriBayer')
+        mono_net = caffe.Net(net_file, caffe.TRAIN)
+        os.remove(net_file)
+        mono_net.blobs['data'].data[...] = patches[:, :1]/256.0
+        mono_net.forward()
+        assert np.allclose(mono_net.blobs['output'].data, net.blobs['mosaick'].data)
+
+    def test_read_error(self):
+        patches = np.random.randint(0, 256, (4, 4, 32, 32)).astype(np.uint8)
+        net = self.data_net(patches, 'demosaicnet.test', 'UnreadableDataLayer')
+
+        # The reader's error reaches forward instead of leaving it waiting
+        self.assertRaises(IOError, net.forward)
+
+    def test_16_bits(self):
+        patches = np.random.randint(0, 65536, (4, 4, 32, 32)).astype(np.uint16)
+        net = self.data_net(patches)
+        assert PatchStore(self.path).header['dtype'] == 'uint16'
+
+        # The default scale follows the depth of the records
+        net.forward()
+        expected = patches/65536.0
+        assert np.allclose(net.blobs['groundtruth'].data, expected[:, 1:])
+        assert np.allclose(net.blobs['mosaick'].data,
+                           expected[:, :1]*mosaick_mask('bayer', 32, 32))
+
+
 class TestReplicateLikeLayer(TestPythonLayer):
     def python_net_file(self):
         with tempfile.NamedTemporaryFile(mode='w+', delete=False) as f:
@@ -389,6 +673,105 @@ class TestReplicateLikeLayer(TestPythonLayer):
             assert (out[i, 0, :, :] == self.net.blobs['data'].data[i]).all()
 
 
+class TestNumpyNet(unittest.TestCase):
+    models = os.path.join(os.path.dirname(__file__), '..', 'pretrained_models')
+
+    def paths(self, model):
+        return (os.path.join(self.models, model, 'deploy.prototxt'),
+                os.path.join(self.models, model, 'weights.caffemodel'))
+
+    def test_matches_caffe(self):
+        for model in ['bayer', 'bayer_noise', 'xtrans']:
+            arch, weights = self.paths(model)
+            cnet = caffe.Net(arch, weights, caffe.TEST)
+            nnet = Net(arch, weights)
+            mosaic_type = 'xtrans' if model == 'xtrans' else 'bayer'
+            im = np.random.rand(2, 3, 72, 72).astype(np.float32)
+            for net in [cnet, nnet]:
+                net.blobs['mosaick'].reshape(*im.shape)
+                mosaick(im, mosaic_type, out=net.blobs['mosaick'].data)
+                if 'noise_level' in net.blobs:
+                    net.blobs['noise_level'].reshape(2)
+                    net.blobs['noise_level'].data[...] = 0.02
+                net.forward()
+            expected = cnet.blobs['output'].data
+            out = nnet.blobs['output'].data
+            assert out.shape == expected.shape
+            assert np.amax(np.abs(out - expected)) < REFERENCE_TOLERANCE
+
+    def test_matches_reference(self):
+        # Caffe outputs checked in by bin/write_references, for hosts without Caffe
+        checked = 0
+        for model in ['bayer', 'bayer_noise', 'xtrans']:
+            path = os.path.join(self.models, model, REFERENCE_FILE)
+            if not os.path.exists(path):
+                continue
+            out, expected = run_reference(Net(*self.paths(model)), path)
+            assert out.shape == expected.shape
+            assert np.amax(np.abs(out - expected)) < REFERENCE_TOLERANCE
+            checked += 1
+        if not checked:
+            self.skipTest('no reference outputs, see bin/write_references')
+
+    def test_reshape(self):
+        net = Net(*self.paths('bayer'))
+        im = np.random.rand(4, 3, 64, 64).astype(np.float32)
+        net.blobs['mosaick'].reshape(*im.shape)
+        net.blobs['mosaick'].data[...] = im
+        net.forward()
+        full = net.blobs['output'].data.copy()
+
+        # A smaller batch reuses the buffers and gives the same tiles
+        net.blobs['mosaick'].reshape(1, 3, 64, 64)
+        net.blobs['mosaick'].data[...] = im[2:3]
+        net.forward()
+        assert net.blobs['output'].data.shape == (1,) + full.shape[1:]
+        assert np.allclose(net.blobs['output'].data, full[2:3], atol=1e-5)
+
+    def test_lazy(self):
+        # The prototxt's 64 tiles input shape is only declared
+        net = Net(*self.paths('bayer_noise'))
+        assert net.blobs['preconv1'].shape[0] == 64
+        assert net.blobs['filters1'].shape == net.blobs['masks1'].shape
+        assert all(b._buffer.size == 0 for b in net.blobs.values())
+
+
+class TestWeightCache(unittest.TestCase):
+    def setUp(self):
+        models = os.path.join(os.path.dirname(__file__), '..', 'pretrained_models')
+        self.dir = tempfile.mkdtemp()
+        self.model = os.path.join(self.dir, 'bayer')
+        shutil.copytree(os.path.join(models, 'bayer'), self.model)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_load(self):
+        net = weightcache.load(self.model)
+        assert weightcache.read_cache(self.model) is not None
+
+        with open(os.path.join(self.model, 'weights.caffemodel'), 'rb') as fid:
+            weights = parse_caffemodel(fid.read())
+        _, cached = weightcache.read_cache(self.model)
+        assert list(cached.keys()) == list(weights.keys())
+        for name in weights:
+            for a, b in zip(cached[name], weights[name]):
+                assert isinstance(a, np.memmap)
+                assert a.ctypes.data % weightcache.CACHE_ALIGNMENT == 0
+                assert np.array_equal(a, b)
+        assert net.blobs['output'].data.shape[1] == 3
+
+    def test_invalidation(self):
+        weightcache.write_cache(self.model)
+        weights = os.path.join(self.model, 'weights.caffemodel')
+        st = os.stat(weights)
+        os.utime(weights, (st.st_atime, st.st_mtime+10))
+        assert weightcache.read_cache(self.model) is None
+
+        weightcache.load(self.model)
+        assert weightcache.read_cache(self.model) is not None
+
+
 class TestNormalizedEuclideaanLayer(TestPythonLayer):
     def python_net_file(self):
         with tempfile.NamedTemporaryFile(mode='w+', delete=False) as f:
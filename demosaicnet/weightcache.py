@@ -0,0 +1,150 @@
+# MIT License
+#
+# Deep Joint Demosaicking and Denoising
+# Siggraph Asia 2016
+# Michael Gharbi, Gaurav Chaurasia, Sylvain Paris, Fredo Durand
+#
+# Copyright (c) 2016 Michael Gharbi
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Flat weight cache of a model folder, for the numpy backend.
+
+The cache sits in the model folder next to deploy.prototxt and
+weights.caffemodel:
+  - weights.bin holds every weight blob as raw float32, each one starting
+    on a CACHE_ALIGNMENT byte boundary.
+  - graph.json holds the parsed prototxt, the offset and shape of each blob
+    and the size and modification time of the files it was built from.
+
+Loading maps weights.bin read-only instead of parsing protobufs, so the
+processes of a host running the same model share its pages. A cache whose
+sources changed is rebuilt on the next load.
+"""
+
+import collections
+import json
+import os
+
+import numpy as np
+
+from demosaicnet.inference import Net, parse_caffemodel, parse_prototxt
+
+ARCH_FILE = 'deploy.prototxt'
+WEIGHTS_FILE = 'weights.caffemodel'
+GRAPH_FILE = 'graph.json'
+CACHE_FILE = 'weights.bin'
+CACHE_ALIGNMENT = 64
+CACHE_VERSION = 1
+
+
+def _sources(model):
+    sources = {}
+    for name in [ARCH_FILE, WEIGHTS_FILE]:
+        st = os.stat(os.path.join(model, name))
+        sources[name] = {'size': st.st_size, 'mtime': st.st_mtime}
+    return sources
+
+
+def write_cache(model):
+    """Parses the model's prototxt and caffemodel, writes its cache.
+
+    Both files are written to temporary names and renamed, weights first,
+    so concurrent readers never see a partial cache.
+    """
+    sources = _sources(model)
+    with open(os.path.join(model, ARCH_FILE)) as fid:
+        arch = parse_prototxt(fid.read())
+    with open(os.path.join(model, WEIGHTS_FILE), 'rb') as fid:
+        weights = parse_caffemodel(fid.read())
+
+    index = collections.OrderedDict()
+    offset = 0
+    cache_path = os.path.join(model, CACHE_FILE)
+    tmp = '{}.{}.tmp'.format(cache_path, os.getpid())
+    with open(tmp, 'wb') as fid:
+        for name, blobs in weights.items():
+            index[name] = []
+            for blob in blobs:
+                pad = -offset % CACHE_ALIGNMENT
+                fid.write(b'\0'*pad)
+                offset += pad
+                fid.write(np.ascontiguousarray(blob, dtype='<f4').tobytes())
+                index[name].append({'offset': offset, 'shape': list(blob.shape)})
+                offset += blob.nbytes
+    os.rename(tmp, cache_path)
+
+    graph = {'version': CACHE_VERSION, 'sources': sources, 'size': offset,
+             'net': arch, 'weights': index}
+    graph_path = os.path.join(model, GRAPH_FILE)
+    tmp = '{}.{}.tmp'.format(graph_path, os.getpid())
+    with open(tmp, 'w') as fid:
+        json.dump(graph, fid)
+    os.rename(tmp, graph_path)
+
+
+def read_cache(model):
+    """Returns the (net, weights) description of a model from its cache.
+
+    Weights are read-only views of the mapped cache file. Returns None if
+    there is no cache or its sources changed since it was written.
+    """
+    graph_path = os.path.join(model, GRAPH_FILE)
+    cache_path = os.path.join(model, CACHE_FILE)
+    try:
+        with open(graph_path) as fid:
+            graph = json.load(fid, object_pairs_hook=collections.OrderedDict)
+        size = os.path.getsize(cache_path)
+    except (IOError, OSError, ValueError):
+        return None
+    if (graph.get('version') != CACHE_VERSION or graph['sources'] != _sources(model)
+            or graph['size'] != size):
+        return None
+
+    weights = collections.OrderedDict()
+    if size > 0:
+        data = np.memmap(cache_path, dtype='<f4', mode='r')
+        for name, blobs in graph['weights'].items():
+            weights[name] = []
+            for blob in blobs:
+                start = blob['offset'] // 4
+                count = int(np.prod(blob['shape']))
+                weights[name].append(data[start:start+count].reshape(blob['shape']))
+    return graph['net'], weights
+
+
+def load(model, cache=True):
+    """Returns the numpy Net of a model folder, through its weight cache.
+
+    A missing or stale cache is rebuilt. If the folder is not writable the
+    net is loaded from the prototxt and caffemodel directly.
+    """
+    if not cache:
+        return Net(os.path.join(model, ARCH_FILE), os.path.join(model, WEIGHTS_FILE))
+
+    graph = read_cache(model)
+    if graph is None:
+        try:
+            write_cache(model)
+        except (IOError, OSError) as e:
+            print 'Could not write the weight cache of {}: {}'.format(model, e)
+            return load(model, cache=False)
+        graph = read_cache(model)
+        if graph is None:  # The sources changed while we were writing
+            return load(model, cache=False)
+    return Net.from_graph(*graph)